@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measures the time needed to build the configuration trees of a set of
+# configurations and to look up properties in them, on generated
+# configuration files.
+# Usage: bench/configs.py [--configs N] [--lookups N] [--bin <bin dir>]
+#
+# --bin can point to the bin directory of another checkout to compare with
+# an older version of plptree.
+
+import argparse
+import collections
+import json
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Measure configuration tree building time')
+parser.add_argument("--configs", dest="configs", default=30, type=int, help="Number of configurations. Default: %(default)s")
+parser.add_argument("--lookups", dest="lookups", default=210, type=int, help="Number of lookups per configuration. Default: %(default)s")
+parser.add_argument("--runs", dest="runs", default=3, type=int, help="Number of runs of each measure. Default: %(default)s")
+parser.add_argument("--bin", dest="bin", default=None, help="Directory of the plptree module to measure. Default: the one of this checkout")
+args = parser.parse_args()
+
+bin_dir = args.bin
+if bin_dir is None:
+    bin_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+sys.path.insert(0, bin_dir)
+
+import plptree
+
+
+def get_subtree(prefix, depth, width):
+    # Values are named after their path so that the lookups by name can
+    # find them anywhere in the tree
+    result = collections.OrderedDict()
+    for i in range(0, width):
+        key = '%s_%d' % (prefix, i)
+        if depth == 0:
+            result[key] = i
+        else:
+            result[key] = get_subtree(key, depth - 1, width)
+    result['%s_version' % prefix] = 1
+    return result
+
+
+def gen_large(path):
+    config = collections.OrderedDict()
+    config['chip'] = 'chip_0'
+    for i in range(0, 60):
+        config['comp%d' % i] = get_subtree('comp%d' % i, 2, 6)
+    with open(os.path.join(path, 'pulp.json'), 'w') as fd:
+        json.dump(config, fd)
+
+
+def gen_includes(path):
+    config = collections.OrderedDict()
+    config['chip'] = 'chip_0'
+    config['includes'] = []
+    for i in range(0, 60):
+        name = 'comp%d.json' % i
+        config['includes'].append(name)
+        with open(os.path.join(path, name), 'w') as fd:
+            json.dump({'comp%d' % i: get_subtree('comp%d' % i, 2, 6)}, fd)
+    with open(os.path.join(path, 'pulp.json'), 'w') as fd:
+        json.dump(config, fd)
+
+
+def get_config_string(nb_configs, deep):
+    configs = []
+    for i in range(0, nb_configs):
+        if deep:
+            items = 'comp%d_0_0_version=%d:comp%d_1_version=%d' % (i % 60, i, (i + 7) % 60, i)
+        else:
+            items = 'chip=chip_%d:comp%d_version=%d' % (i, i % 60, i)
+        configs.append('config%d@%s' % (i, items))
+    return ';'.join(configs)
+
+
+def get_lookups(nb_lookups):
+    names = []
+    for i in range(0, nb_lookups):
+        comp = 'comp%d' % (i % 60)
+        if i % 3 == 0:
+            names.append('%s/%s_%d/%s_%d_version' % (comp, comp, i % 6, comp, i % 6))
+        elif i % 3 == 1:
+            names.append('%s_%d_%d' % (comp, i % 6, (i + 1) % 6))
+        else:
+            names.append('chip')
+    return names
+
+
+def measure(name, path, config_string, lookups):
+    build_durations = []
+    lookup_durations = []
+    for run in range(0, args.runs):
+        # Start from files which were not read yet
+        if hasattr(plptree, 'json_cache'):
+            plptree.json_cache.clear()
+
+        start = time.perf_counter()
+        configs = plptree.get_configs(
+            config_files=[os.path.join(path, 'pulp.json')],
+            config_string=config_string, path=path)
+        build_durations.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for config in configs:
+            for lookup in lookups:
+                config.get(lookup)
+        lookup_durations.append(time.perf_counter() - start)
+
+    print ('%-30s build %8.2f s   lookups %8.2f s' % (
+        name, min(build_durations), min(lookup_durations)))
+
+
+for env in ['PULP_CURRENT_CONFIG_ARGS', 'PULP_CURRENT_CONFIG_ARGS_NEW',
+            'PULP_CONFIG_EXT', 'PULP_CONFIGS_CACHE']:
+    os.environ.pop(env, None)
+
+lookups = get_lookups(args.lookups)
+
+with tempfile.TemporaryDirectory() as path:
+    os.environ['PULP_CONFIGS_PATH'] = path
+    gen_large(path)
+    measure('one large file', path,
+            get_config_string(args.configs, False), lookups)
+
+with tempfile.TemporaryDirectory() as path:
+    os.environ['PULP_CONFIGS_PATH'] = path
+    gen_includes(path)
+    measure('includes, shallow items', path,
+            get_config_string(args.configs, False), lookups)
+    measure('includes, deep items', path,
+            get_config_string(args.configs, True), lookups)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measures the startup costs of plpbuild: module imports, distribution
+# detection and project configuration loading.
+# Usage: bench/startup.py [--project <project.cfg>] [--runs N]
+
+import argparse
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+bin_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'bin')
+sys.path.insert(0, bin_dir)
+
+import plptools_config
+
+
+def measure(name, func, runs):
+    durations = []
+    for i in range(0, runs):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    print ('%-40s median %8.2f ms   min %8.2f ms' % (
+        name, durations[len(durations) // 2] * 1000, durations[0] * 1000))
+
+
+def import_module(module):
+    env = os.environ.copy()
+    env['PYTHONPATH'] = bin_dir + ':' + env.get('PYTHONPATH', '')
+    # A failed import would be measured as a fast one
+    subprocess.check_call([sys.executable, '-c', 'import %s' % module], env=env,
+                          stdout=subprocess.DEVNULL)
+
+
+def lsb_release():
+    for field in ['Distributor', 'Release']:
+        subprocess.Popen(
+            "lsb_release -a | grep %s" % field, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).communicate()
+
+
+parser = argparse.ArgumentParser(description='Measure plpbuild startup time')
+parser.add_argument("--project", dest="project", default=None, help="Project configuration file to load")
+parser.add_argument("--runs", dest="runs", default=10, type=int, help="Number of runs of each measure. Default: %(default)s")
+args = parser.parse_args()
+
+measure('python startup', lambda: import_module('os'), args.runs)
+for module in ['plpobjects', 'plptools']:
+    measure('import %s' % module, lambda: import_module(module), args.runs)
+
+measure('distrib from os-release', plptools_config.get_distrib_info, args.runs)
+measure('distrib from lsb_release', lsb_release, args.runs)
+
+if args.project is not None:
+    os.environ.setdefault('PULP_PROJECT_HOME', os.path.dirname(os.path.realpath(args.project)))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        measure('config without cache', lambda: plptools_config.load_config_module(
+            args.project, 'project'), args.runs)
+        measure('config with cache', lambda: plptools_config.load_config_module(
+            args.project, 'project', cache_dir=cache_dir), args.runs)
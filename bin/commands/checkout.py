@@ -17,47 +17,127 @@
 import commands.commands as cmd
 from plptools_exec import Cmd_group
 import os
-import subprocess
+import shlex
+import shutil
+import hashlib
 import plptools_builder
+import plptools_git
 
 
+# Last git job enqueued for each checked out path, so that modules nested
+# into another one wait for it
+scm_jobs = {}
+
+# Mirror update job of each URL, as it is only fetched once per run
+mirror_jobs = {}
+
+# Last submodule job enqueued for each superproject. Submodules share the
+# locks of their superproject so they are checked out one after the other.
+submodule_jobs = {}
+
+
+def get_parent_jobs(path):
+    jobs = []
+    for job_path, job in scm_jobs.items():
+        if path.startswith(os.path.join(job_path, '')):
+            jobs.append(job)
+    return jobs
+
+
+def scm_job_end(cmd_group, path, command):
+    # The git state of the module is not the same anymore
+    plptools_git.metadata.invalidate([path])
+    cmd_group.dec_enqueued(command=command)
+
+
+def enqueue_scm_job(self, pkg, builder, cmd_group, name, cmd, path, deps):
+    cmd_group.inc_enqueued()
+    job = plptools_builder.Builder_command(
+        name='%s:%s:%s' % (pkg, self.name, name), cmd=cmd, path=path,
+        env=os.environ.copy(), deps=deps)
+    job.set_callback(callback=scm_job_end, cmd_group=cmd_group,
+                     path=self.abs_path, command=job)
+    builder.enqueue(cmd=job)
+    return job
+
+
+def get_mirror_path(mirror_dir, url):
+    name = os.path.basename(url.rstrip('/'))
+    if name.endswith('.git'):
+        name = name[:-4]
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(mirror_dir, '%s-%s.git' % (name, digest))
+
+
+def enqueue_mirror_job(self, pkg, builder, cmd_group, mirror_dir):
+    job = mirror_jobs.get(self.url)
+    if job is None:
+        path = get_mirror_path(mirror_dir, self.url)
+        cmd = 'if [ -d %s ]; then git -C %s fetch --prune --tags; else git clone --mirror %s %s; fi' % (
+            shlex.quote(path), shlex.quote(path), shlex.quote(self.url), shlex.quote(path))
+        cmd = 'sh -c %s' % shlex.quote(cmd)
+        # Other workspaces of the host may update the same mirror
+        if shutil.which('flock') is not None:
+            cmd = 'flock %s %s' % (shlex.quote(path + '.lock'), cmd)
+        os.makedirs(mirror_dir, exist_ok=True)
+        job = enqueue_scm_job(self, pkg, builder, cmd_group, 'mirror', cmd,
+                              mirror_dir, [])
+        mirror_jobs[self.url] = job
+    return job
+
+
+def get_git_sync_command(version, pull=True):
+    # Executed in a shell so that the whole sequence is one builder job
+    version = shlex.quote(version)
+    cmd = 'git fetch -t && git checkout %s' % version
+    if pull:
+        # The version may be a branch, in which case it must be updated
+        cmd += ' && { [ "$(git log -n 1 --format=format:%%H)" = %s ] || git pull; }' % version
+    return 'sh -c %s' % shlex.quote(cmd)
 
 
 @cmd.register_module_cmd
 def checkout(self, pkg, builder, cmd_group):
 
-    ret = 0
+    deps = []
 
     if self.scm == 'gitmodule':
-        cwd = os.getcwd()
-        os.chdir(self.root_dir)
-        ret += self.exec_cmd(pkg, "git submodule update --init --recursive %s" % self.path, 'checkout', chdir=False)
-        os.chdir(cwd)
+        self.dump_msg(pkg, 'checkout')
+        last_job = submodule_jobs.get(self.root_dir)
+        job = enqueue_scm_job(
+            self, pkg, builder, cmd_group, 'submodule',
+            'git submodule update --init --recursive %s' % self.path,
+            self.root_dir, [last_job] if last_job is not None else [])
+        submodule_jobs[self.root_dir] = job
+        deps = [job]
 
     elif self.scm == 'git':
-        ret = 0
         if self.url is not None:
             self.dump_msg(self, 'checkout')
+            deps = get_parent_jobs(self.abs_path)
             if not os.path.exists(self.abs_path):
-                cmd = "git clone %s %s" % (self.url, self.abs_path)
-                if os.system(cmd) != 0:
-                    return -1
-            cwd = os.getcwd()
-
-            os.chdir(self.abs_path)
-
-            # We may get an exception if the version is not specified, just
-            # ignore it
+                clone_cmd = 'git clone %s %s' % (self.url, self.abs_path)
+                mirror_dir = pkg.project.git_mirror
+                if mirror_dir is not None:
+                    # Objects are copied from the local mirror, the clone
+                    # does not depend on it afterwards
+                    deps = deps + [enqueue_mirror_job(
+                        self, pkg, builder, cmd_group, mirror_dir)]
+                    clone_cmd = 'git clone --reference %s --dissociate %s %s' % (
+                        get_mirror_path(mirror_dir, self.url), self.url,
+                        self.abs_path)
+                deps = [enqueue_scm_job(
+                    self, pkg, builder, cmd_group, 'clone', clone_cmd,
+                    self.root_dir, deps)]
+
+            # Nothing to synchronize if the version is not specified
             if self.version is not None:
-                ret += os.system("git fetch")
-                ret += os.system("git checkout %s" % (self.version))
-
-                cmd = 'git log -n 1 --format=format:%H'.split()
-                output = subprocess.check_output(cmd)
-                if output.decode('utf-8') != self.version:
-                    ret += os.system("git pull")
+                deps = [enqueue_scm_job(
+                    self, pkg, builder, cmd_group, 'fetch',
+                    get_git_sync_command(self.version), self.abs_path, deps)]
 
-            os.chdir(cwd)
+            if len(deps) != 0:
+                scm_jobs[self.abs_path] = deps[-1]
 
         step = self.steps.get('checkout')
         if step is not None:
@@ -65,7 +145,9 @@ def checkout(self, pkg, builder, cmd_group):
             cmd_group.inc_enqueued()
             cmd = plptools_builder.Builder_command(
                 name=name, cmd=step.command, path=self.abs_path,
-                env=self.get_env_for_command(pkg))
+                env=self.get_env_for_command(pkg), deps=deps,
+                retry=getattr(step, 'retry', None),
+                **self.get_step_resources(step))
             cmd.set_callback(callback=cmd_group.dec_enqueued, command=cmd)
             builder.enqueue(cmd=cmd)
 
@@ -73,7 +155,7 @@ def checkout(self, pkg, builder, cmd_group):
         self.dump_error(pkg, 'Unknown SCM: %s' % self.scm)
         return -1
 
-    return ret
+    return 0
 
 
 
@@ -27,18 +27,8 @@ import datetime
 #import plptree
 import subprocess
 
-try:
-    import smtplib
-    from openpyxl import Workbook
-    from xlsxwriter.utility import xl_rowcol_to_cell
-    from openpyxl.worksheet.table import Table, TableStyleInfo
-    from email.mime.multipart import MIMEMultipart
-    from email.mime.text import MIMEText
-    from email.mime.base import MIMEBase
-    from email import encoders
-
-except:
-    raise
+# The report, mail and database modules are only imported when they are
+# used, as they are slow to load and not needed by most commands
 
 
 class Package_Build(object):
@@ -469,6 +459,8 @@ class Report_table(object):
 
 
     def dump_to_xls(self, ws):
+        from xlsxwriter.utility import xl_rowcol_to_cell
+        from openpyxl.worksheet.table import Table, TableStyleInfo
 
         first_row = ws._current_row
 
@@ -534,6 +526,11 @@ class Report(object):
         print (self.get_text())
 
     def dump_to_mail(self, subject, attachments=[], author_email=None):
+        import smtplib
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        from email.mime.base import MIMEBase
+        from email import encoders
 
         if author_email is None:
             print ('No email was specified, dropping report')
@@ -566,6 +563,7 @@ class Report(object):
 
 
     def dump_to_xls(self, xls):
+        from openpyxl import Workbook
 
         wb = Workbook()
         ws = wb.active
@@ -595,6 +593,7 @@ class PulpObjects(object):
         self.db_info = db_info
         self.db_env = db_env
         if db_import:
+            import plpdb
             self.db = plpdb.PulpDb()
             self.builds += self.db.get_builds()
             if import_tests:
@@ -17,6 +17,7 @@
 
 
 import plptools as plp
+import plptools_builder
 
 class PkgDep(plp.PkgDep):
 
@@ -41,11 +42,24 @@ class Module(plp.Module):
     super(Module, self).__init__(*kargs, **kwargs)
 
 
+class RetryPolicy(plptools_builder.Retry_policy):
+
+  def __init__(self, *kargs, **kwargs):
+    super(RetryPolicy, self).__init__(*kargs, **kwargs)
+
+
 class BuildStep(object):
 
-  def __init__(self, name, command):
+  # cpu is the number of job slots used by the step, memory is in MB and an
+  # exclusive step runs alone. When not specified, the module ones are used.
+  # retry is a RetryPolicy overriding the global one for this step.
+  def __init__(self, name, command, cpu=None, memory=None, exclusive=None, retry=None):
     self.name = name
     self.command = command
+    self.retry = retry
+    self.cpu = cpu
+    self.memory = memory
+    self.exclusive = exclusive
 
 
 class Group(plp.Group):
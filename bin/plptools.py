@@ -17,10 +17,17 @@
 
 import os
 import os.path
-import imp
 import plpartifactory
-import subprocess
 import plptools_builder
+import plptools_history
+import plptools_cache
+import plptools_jobserver
+import plptools_trace
+import plptools_load
+import plptools_remote
+import plptools_graph
+import plptools_git
+import plptools_config
 from twisted.internet import reactor
 import hashlib
 import collections
@@ -75,21 +82,10 @@ c['testsets'] = [ tests ]
 
 
 def get_git_version(path):
-    if not os.path.exists(path):
-        return None
-    cwd = os.getcwd()
-    os.chdir(path)
-    gitVersion = subprocess.check_output('git log -n 1 --format=format:%H'.split()).decode('utf-8')
-    os.chdir(cwd)
-    return gitVersion
+    return plptools_git.metadata.get_head(path)
 
 def is_git_modified(path):
-    cwd = getRootDir()
-    os.chdir(path)
-    isModified = os.system('git diff-index --quiet HEAD --') != 0
-    gitVersion = subprocess.check_output('git log -n 1 --format=format:%H'.split()).decode('utf-8')
-    os.chdir(cwd)
-    return isModified
+    return plptools_git.metadata.is_modified(path)
 
 
 class bcolors:
@@ -111,24 +107,29 @@ def get_root_dir():
 class Sourceme(object):
 
     def __init__(self, path, name):
-        try:
-            os.makedirs(path)
-        except Exception:
-            pass
-        self.csh_file = open(os.path.join(path, '%s.csh' % name), 'w')
-        self.sh_file = open(os.path.join(path, '%s.sh' % name), 'w')
+        self.path = path
+        self.name = name
+        self.csh_lines = []
+        self.sh_lines = []
 
     def add_export(self, key, value):
-        self.csh_file.write('setenv %s %s\n' % (key, value))
-        self.sh_file.write('export %s=%s\n' % (key, value))
+        self.csh_lines.append('setenv %s %s\n' % (key, value))
+        self.sh_lines.append('export %s=%s\n' % (key, value))
 
     def add_sourceme(self, sh_name, csh_name):
-        self.csh_file.write('source %s\n' % (csh_name))
-        self.sh_file.write('source %s\n' % (sh_name))
+        self.csh_lines.append('source %s\n' % (csh_name))
+        self.sh_lines.append('source %s\n' % (sh_name))
 
     def gen(self):
-        self.csh_file.close()
-        self.sh_file.close()
+        try:
+            os.makedirs(self.path)
+        except Exception:
+            pass
+        # Files are only rewritten when their content changes
+        plptools_cache.update_file(
+            os.path.join(self.path, '%s.csh' % self.name), ''.join(self.csh_lines))
+        plptools_cache.update_file(
+            os.path.join(self.path, '%s.sh' % self.name), ''.join(self.sh_lines))
 
 
 
@@ -144,7 +145,8 @@ class Group(object):
 
 
 class Module(object):
-    def __init__(self, name, path=None, url=None, steps=[], deps=[], parameters=[], env={}, testsets=[], restrict=None, scm='git'):
+    def __init__(self, name, path=None, url=None, steps=[], deps=[], parameters=[], env={}, testsets=[], restrict=None, scm='git',
+                 cpu=1, memory=0, exclusive=False):
         self.name = name
         self.path = path
         self.url = url
@@ -157,11 +159,15 @@ class Module(object):
         for step in steps:
             self.steps[step.name] = step
         self.version = None
-        self.git_version = None
         self.branch = None
         self.restrict = restrict
-        self.active_configs = []
+        self.active_configs = set()
+        self.base_envs = {}
         self.scm = scm
+        # Default resources of the module steps, each step can override them
+        self.cpu = cpu
+        self.memory = memory
+        self.exclusive = exclusive
 
     def set_pkg(self, pkg):
         self.pkg = pkg
@@ -181,13 +187,14 @@ class Module(object):
 
         for config in configs:
             if self.restrict is None or eval(self.restrict):
-                self.active_configs.append(config.get_name())
+                self.active_configs.add(config.get_name())
                 result = True
 
         return result
 
     def check_configs(self, configs):
         self.active = self.__find_active_config(configs)
+        self.base_envs = {}
 
     def set_root_dir(self, path):
         self.root_dir = path
@@ -199,9 +206,38 @@ class Module(object):
     def get_version(self):
         if self.version is not None:
             return self.version
-        if self.git_version is None:
-            self.git_version = get_git_version(self.path)
-        return self.git_version
+        return get_git_version(self.abs_path)
+
+    def is_modified(self):
+        # Local modifications are not reflected by the version, so a module
+        # which can't be identified this way is considered as modified
+        if self.scm not in ['git', 'gitmodule'] or not os.path.exists(self.abs_path):
+            return True
+        return is_git_modified(self.abs_path) is not False
+
+    def get_step_resources(self, step):
+        resources = {}
+        for name in ['cpu', 'memory', 'exclusive']:
+            value = getattr(step, name, None)
+            resources[name] = value if value is not None else getattr(self, name)
+        return resources
+
+    def get_cache_key(self, pkg, config, step, env):
+        # Only the environment coming from the packages and modules is taken
+        # into account, not the one of the user shell
+        env_items = []
+        for key in sorted(env.keys()):
+            if os.environ.get(key) != env[key]:
+                env_items += [key, env[key]]
+
+        config_items = None
+        if config is not None:
+            config_items = pkg.project.get_config_name_from_items(
+                config, self.parameters)
+
+        return plptools_cache.get_digest(
+            [pkg.name, self.name, step.name, step.command, self.get_version(),
+             config_items] + env_items + pkg.get_build_deps_versions())
 
     def dump_msg(self, pkg, cmd, msg=None):
         print ()
@@ -216,7 +252,7 @@ class Module(object):
 
     def update(self):
       self.dump_msg(self, 'update')
-      new_version = get_git_version(self.path)
+      new_version = get_git_version(self.abs_path)
       if new_version is not None:
         self.version = new_version
 
@@ -230,16 +266,24 @@ class Module(object):
         testsets.append([self.name.replace('-', '_'), os.path.join(self.path, testset)])
       return testsets
 
-    def get_env_for_command(self, pkg, config=None):
+    def get_base_env(self, pkg):
+        # Environment shared by all the commands of this module for this
+        # package, only the current config differs between them so it is
+        # computed once. It must not be modified by the commands.
+        env = self.base_envs.get(pkg)
+        if env is None:
+            env = pkg.get_base_env().copy()
+            for key, value in self.env.items():
+                env[key] = eval(value)
+            self.base_envs[pkg] = env
+        return env
 
-        env = os.environ.copy()
-        env['PKG_DIR'] = pkg.get_absolute_path()
-        pkg.get_env(env)
+    def get_env_for_command(self, pkg, config=None):
 
-        for key, value in self.env.items():
-            env[key] = eval(value)
+        env = self.get_base_env(pkg)
 
         if config is not None:
+            env = env.copy()
             env['PULP_CURRENT_CONFIG'] = config.get_name()
 
         return env
@@ -270,25 +314,24 @@ class Module(object):
         builder.enqueue(cmd=module_job)
 
         configs_last_cmd = []
-        job_configs = []
 
-        for configId in range(0, len(configs)):
+        # Configs which only differ by items the module is not sensitive to
+        # are built once, with the first config of each group
+        config_groups = pkg.project.get_config_groups(
+            [config for config in configs if self.is_active_config(config)],
+            self.parameters)
 
-            config = configs[configId]
+        for config_group in config_groups.values():
 
-            if not self.is_active_config(config):
-                continue
+            config = config_group[0]
 
             config_last_cmd = None
 
-            # Extract the items from the config on which the module is sentitive to check
-            # if we should consider it as already processed
-            job_config = config.get_name_from_items(self.parameters)
-            if job_config in job_configs: continue
-            job_configs.append(job_config)
-
             self.nb_pending_configs += 1
 
+            # All the steps of this config share the same environment
+            env = self.get_env_for_command(pkg, config)
+
             # The first step always depend on the module job, to get triggered when all module deps are finished
             prev_step = module_job
             for i in range(0, len(steps)):
@@ -298,10 +341,17 @@ class Module(object):
                 # Only the last step has a callback to update the module
                 else: name = '%s:%s:%s' % (pkg, self.name, step)
                 if len(self.parameters) != 0: name += ' (%s)' % (config.name)
+                cache_key = None
+                if builder.cache is not None and not self.is_modified() and \
+                        pkg.get_build_deps_versions() is not None:
+                    cache_key = self.get_cache_key(pkg, config, self.steps.get(step), env)
                 cmd_group.inc_enqueued()
                 prev_step = plptools_builder.Builder_command(
                   name=name, cmd=self.steps.get(step).command, path=self.abs_path,
-                  env=self.get_env_for_command(pkg, config), deps=[prev_step])
+                  env=env, deps=[prev_step], cache_key=cache_key,
+                  output_dir=pkg.get_install_dir(),
+                  retry=getattr(self.steps.get(step), 'retry', None),
+                  **self.get_step_resources(self.steps.get(step)))
                 prev_step.set_callback(callback=cmd_group.dec_enqueued, command=prev_step)
                 builder.enqueue(cmd=prev_step)
                 config_last_cmd = prev_step
@@ -331,19 +381,19 @@ class Module(object):
         return retval
 
 
-    def sync(self):
+    def sync(self, pkg, builder, cmd_group):
 
-        if os.path.exists(self.name):
-            cwd = os.getcwd()
-            os.chdir(self.name)
-
-            if os.system('git fetch -t') != 0:
-                return -1
-
-            if os.system('git checkout %s' % self.get_version()) != 0:
-                return -1
-
-            os.chdir(cwd)
+        if os.path.exists(self.abs_path):
+            name = '%s:%s:sync' % (pkg, self.name)
+            cmd_group.inc_enqueued()
+            cmd = plptools_builder.Builder_command(
+              name=name, path=self.abs_path, env=os.environ.copy(),
+              cmd=commands.checkout.get_git_sync_command(
+                self.get_version(), pull=False))
+            cmd.set_callback(callback=commands.checkout.scm_job_end,
+                             cmd_group=cmd_group, path=self.abs_path,
+                             command=cmd)
+            builder.enqueue(cmd=cmd)
 
         return 0
 
@@ -387,6 +437,9 @@ class Package(object):
         self.artifact = artifact
         self.restrict = restrict
         self.env = env
+        self.base_env = None
+        self.all_build_deps = None
+        self.build_deps_versions = False
         self.sourceme = sourceme
 
         self.tagVersion = None
@@ -427,7 +480,10 @@ class Package(object):
         cmd_func = cmd.get_module_cmd(command)
 
         groups, modules = self.get_default_groups_and_modules(groups, modules)
-        modules = self.get_modules_from_groups(groups, modules)
+        # Ordered so that the jobs enqueued by the commands can depend on the
+        # ones of the previous modules
+        modules = self.__get_ordered_modules(
+            self.get_modules_from_groups(groups, modules))
         for module_name in modules:
             module = self.modules.get(module_name)
             if not module.is_active(): continue
@@ -494,6 +550,8 @@ class Package(object):
 
     def check_configs(self, configs):
         self.active = self.__find_active_config(configs)
+        self.base_env = None
+        self.build_deps_versions = False
         self.active_modules = collections.OrderedDict()
         for module in self.modules.values():
             module.check_configs(configs)
@@ -508,12 +566,8 @@ class Package(object):
         if only_pkg: return self.build_deps_pkg
         else: return self.build_deps
 
-    def get_all_exec_deps(self, only_pkg=True):
-        deps = []
-        pkg_list = self.exec_deps_pkg if only_pkg else self.exec_deps
-        for dep in pkg_list:
-            list(set(deps).union(dep.get_all_exec_deps()))
-        return deps
+    def get_all_exec_deps(self):
+        return self.project.get_exec_graph().get_closure(self)
 
     def get_exec_deps_for_configs(self, configs):
         results = []
@@ -524,12 +578,33 @@ class Package(object):
         return results
 
 
-    def get_all_build_deps(self, only_pkg=True):
-        deps = []
-        pkg_list = self.build_deps_pkg if only_pkg else self.build_deps
-        for dep in pkg_list:
-            deps = list(set(deps).union([dep] + dep.get_all_exec_deps()))
-        return deps
+    def get_all_build_deps(self):
+        # The build dependencies and everything they need for execution
+        if self.all_build_deps is None:
+          deps = set()
+          for dep in self.build_deps_pkg:
+            deps.add(dep)
+            deps.update(dep.get_all_exec_deps())
+          self.all_build_deps = self.project.get_dep_graph().sort(deps)
+        return self.all_build_deps
+
+    def get_build_deps_versions(self):
+        # Versions of everything the package is built against, None if one
+        # of the modules has local modifications as it is then not
+        # identified by its version
+        if self.build_deps_versions is False:
+          versions = []
+          for dep in self.get_all_build_deps():
+            versions += [dep.name, dep.get_version(get_hash=False)]
+            for module in dep.modules.values():
+              if module.is_modified():
+                versions = None
+                break
+              versions += [module.name, module.get_version()]
+            if versions is None:
+              break
+          self.build_deps_versions = versions
+        return self.build_deps_versions
 
     def get_dependencies(self, project, configs, dep_list, alreadyGot=[],
                          force=False):
@@ -588,6 +663,16 @@ class Package(object):
           if not dep.is_active(): continue
           dep.get_env(dict)
 
+    def get_base_env(self):
+        # Environment of the commands building this package, evaluated once
+        # and shared by all its modules
+        if self.base_env is None:
+          env = os.environ.copy()
+          env['PKG_DIR'] = self.get_absolute_path()
+          self.get_env(env)
+          self.base_env = env
+        return self.base_env
+
     def get_hash_str(self):
           return self.project.get_version()
           hashStr = ''
@@ -633,24 +718,13 @@ class Package(object):
         return os.path.join(self.name, self.get_version(get_hash=True))
 
     def __get_ordered_modules(self, modules):
+        # The names may come from sets, start from the declaration order
+        names = set(modules)
+        modules = [name for name in self.modules.keys() if name in names]
 
-        for index in range(0, len(modules)):
-          while True:
-            module = self.modules.get(modules[index])
-            moved = False
-            if module.deps != None:
-              for dep in module.deps:
-                if not dep.name in modules: continue
-                dep_index = modules.index(dep.name)
-                if dep_index > index:
-                  modules.pop(index)
-                  modules.insert(dep_index+1, module.name)
-                  moved = True
-                  break
-
-            if not moved: break
-
-        return modules
+        return plptools_graph.get_topological_order(
+          modules,
+          lambda name: [dep.name for dep in self.modules[name].deps or []])
 
     def get_modules_from_groups(self, groups, modules):
         """
@@ -681,12 +755,18 @@ class Package(object):
 
         return 0
 
-    def dump_env_to_file(self, file):
+    def dump_env_to_file(self, file, visited=None):
+
+        # Shared dependencies are only dumped once
+        if visited is None:
+            visited = set()
+        visited.add(self)
 
         for line in self.sourceme:
             if line[0] == 'exec_deps':
                 for dep in self.get_exec_deps():
-                    dep.dump_env_to_file(file)
+                    if dep not in visited:
+                        dep.dump_env_to_file(file, visited)
             elif line[0] == 'property':
                 file.add_export(line[1], line[2])
             elif line[0] == 'property_eval':
@@ -717,14 +797,10 @@ class Package(object):
 
         sourceme_file.gen()
 
-    def env_get(self):
-        env = []
-        for deps in self.get_build_deps() + self.get_exec_deps():
-          env += deps.env_get()
+    def get_sourceme(self):
         if len(self.sourceme) != 0:
-          env.append(os.path.join(self.get_absolute_path(), 'sourceme'))
-          
-        return env
+          return os.path.join(self.get_absolute_path(), 'sourceme')
+        return None
 
     def deploy(self, project, artifactory):
         if artifactory.deploy_artifact(name=self.name, path=self.get_artifact_path(project.distrib), rel_path=self.get_rel_path(), dir_path=self.get_absolute_path(), real_rel_path=self.get_real_rel_path()):
@@ -807,7 +883,7 @@ class Package(object):
 
         return 0
 
-    def sync(self, groups, modules):
+    def sync(self, builder, cmd_group, groups, modules):
 
         groups, modules = self.get_default_groups_and_modules(groups, modules)
         modules = self.__get_ordered_modules(
@@ -815,7 +891,7 @@ class Package(object):
         for name in modules:
             module = self.modules[name]
             if not module.is_active(): continue
-            module.sync()
+            module.sync(self, builder, cmd_group)
 
 
     def build(self, builder, cmd_group, configs, groups, modules, steps):
@@ -886,7 +962,13 @@ class Project(object):
                  versionsName='versions.cfg', packages=None, force=False,
                  distrib=None, nb_threads=1, cmd_callback=None, log=None,
                  stdout=False, stdout_cached=False, db=False, db_info=None,
-                 import_tests=False, branch=None, db_env=[], commit=None):
+                 import_tests=False, branch=None, db_env=[], commit=None,
+                 history=True, history_path=None, regression_ratio=2.0,
+                 cache=None, log_dir=None, log_max_size=1024*1024,
+                 log_tail_size=64*1024, jobserver=False, trace=None,
+                 threads_auto=False, min_threads=1, min_free_memory=1024,
+                 max_memory=None, keep_going=False, retry_policy=None,
+                 workers=None, git_mirror=None):
 
         if db_info is not None and os.path.exists(db_info):
             os.remove(db_info)
@@ -930,14 +1012,62 @@ class Project(object):
             module_versions=self.config.get('module_versions'),
             module_branches=self.config.get('module_branches'))
 
+        # Local mirrors of the module repositories, shared between
+        # workspaces to avoid cloning again from the remote
+        self.git_mirror = None
+        if git_mirror is not None:
+            self.git_mirror = os.path.abspath(git_mirror)
+
         # Get the artifact cache
         self.artifactory = plpartifactory.ArtifactRepositorySetCached(
             self.config.get('artifact_cache'),
             self.config.get('artifactory_servers'))
 
+        # Durations of the previous runs, used to prioritize the jobs and to
+        # report an ETA and the steps which regressed
+        build_history = None
+        if history:
+            if history_path is None:
+                history_path = os.path.join(self.path, '.plpbuild', 'history.json')
+            build_history = plptools_history.Build_history(
+                history_path, regression_ratio=regression_ratio)
+
+        # In auto mode, nb_threads is the maximum number of commands and the
+        # actual number follows the load of the machine
+        load_monitor = None
+        if threads_auto:
+            load_monitor = plptools_load.Load_monitor(
+                min_threads=min_threads, max_threads=nb_threads,
+                min_free_memory=min_free_memory)
+
+        # Memory budget of the steps, the whole machine by default
+        if max_memory is None:
+            try:
+                max_memory = plptools_load.get_total_memory()
+            except (OSError, ValueError):
+                max_memory = None
+
+        # Full output of each command, only the end of it is kept in memory
+        if log_dir is None:
+            log_dir = os.path.join(self.path, '.plpbuild', 'logs')
+
+        # The step cache is opt-in as it needs to scan the install tree
+        # around each step to find its outputs
+        step_cache = None
+        if cache is not None:
+            step_cache = plptools_cache.Step_cache(
+                cache, generated_files=['sourceme.sh', 'sourceme.csh'])
+
         self.builder = plptools_builder.Builder(
             nb_threads=nb_threads, log=log, stdout=stdout,
-            stdout_cached=stdout_cached)
+            stdout_cached=stdout_cached, history=build_history,
+            cache=step_cache, log_dir=log_dir, log_max_size=log_max_size,
+            log_tail_size=log_tail_size,
+            jobserver=plptools_jobserver.Jobserver(nb_threads) if jobserver else None,
+            trace=plptools_trace.Build_trace(trace) if trace is not None else None,
+            load_monitor=load_monitor, max_memory=max_memory,
+            keep_going=keep_going, retry_policy=retry_policy,
+            executor=plptools_remote.Remote_executor(workers) if workers else None)
 
     def get_commit(self):
         if self.commit is not None:
@@ -965,14 +1095,8 @@ class Project(object):
             distrib = os.environ.get('PULP_ARTIFACTORY_DISTRIB')
 
         if distrib is None:
-            dist = subprocess.Popen(
-                "lsb_release -a | grep Distributor | awk '{print $3}'",
-                shell=True, stdout=subprocess.PIPE, universal_newlines=True
-            ).stdout.read().strip()
-            version = subprocess.Popen(
-                "lsb_release -a | grep Release | awk '{print $2}'",
-                shell=True, stdout=subprocess.PIPE, universal_newlines=True
-            ).stdout.read().strip().split('.')[0]
+            dist, version = plptools_config.get_distrib_info()
+            version = version.split('.')[0]
             distrib = '%s_%s' % (dist, version)
 
             # Map all LinuxMint and Ubuntu < 16 versions to Ubuntu 14
@@ -985,7 +1109,9 @@ class Project(object):
     def __load_config(self, path):
 
         try:
-            module = imp.load_source('project', path)
+            module = plptools_config.load_config_module(
+                path, 'project',
+                cache_dir=os.path.join(self.path, '.plpbuild', 'config'))
         except Exception:
             raise Exception(
                 bcolors.FAIL + 'Unable to open project configuration file: ' +
@@ -1053,6 +1179,85 @@ class Project(object):
             pkg.set_root_dir(self.path)
             pkg.set_project(self, self.pobjs, self.branch)
 
+        # Items of the configs on which the modules are sensitive, computed
+        # once per config for all modules
+        self.parameter_keys = set()
+        for pkg in self.packages.values():
+            for module in pkg.get_modules():
+                self.parameter_keys.update(module.parameters)
+        self.config_items = {}
+
+        # Git information of all modules is queried at once when first needed
+        plptools_git.metadata.register([self.path] + [
+            module.abs_path for module in self.modules.values()])
+
+        self.dep_graph = None
+        self.exec_graph = None
+
+    def get_config_items(self, config):
+        items = self.config_items.get(config)
+        if items is None:
+            items = {}
+            for key in self.parameter_keys:
+                items[key] = config.get_name_from_items([key])
+            self.config_items[config] = items
+        return items
+
+    def get_config_name_from_items(self, config, parameters):
+        """
+        Same as config.get_name_from_items(parameters), from the table of
+        config items.
+        """
+        items = self.get_config_items(config)
+        result = []
+        for key in parameters:
+            item = items.get(key)
+            if item is None:
+                item = config.get_name_from_items([key])
+            if item != '':
+                result.append(item)
+        return ':'.join(result)
+
+    def get_config_groups(self, configs, parameters):
+        """
+        Return the configs grouped by their values of the given parameters,
+        each group being equivalent for a module declaring them.
+        """
+        groups = collections.OrderedDict()
+        for config in configs:
+            name = self.get_config_name_from_items(config, parameters)
+            groups.setdefault(name, []).append(config)
+        return groups
+
+    def get_dep_graph(self):
+        # Build and execution dependencies between packages
+        if self.dep_graph is None:
+            self.dep_graph = plptools_graph.Dependency_graph(
+                self.packages.values(),
+                lambda pkg: pkg.get_build_deps() + pkg.get_exec_deps())
+            # Reports dependency cycles before anything is done
+            self.dep_graph.get_order()
+        return self.dep_graph
+
+    def get_exec_graph(self):
+        if self.exec_graph is None:
+            self.exec_graph = plptools_graph.Dependency_graph(
+                self.packages.values(), lambda pkg: pkg.get_exec_deps())
+        return self.exec_graph
+
+    def get_packages_with_deps(self, packages=None, deps=False):
+        """
+        Return the buildable packages, plus their active dependencies if deps
+        is True, in an order where dependencies come first.
+        """
+        pkgs = set(self.get_buildable_packages(packages=packages))
+        if deps:
+            for pkg in list(pkgs):
+                for dep in pkg.get_all_build_deps() + pkg.get_all_exec_deps():
+                    if dep.is_active():
+                        pkgs.add(dep)
+        return self.get_dep_graph().sort(pkgs)
+
     def __load_system_configs(self, configs):
         self.configs = plpconf.get_configs_from_env()
 
@@ -1121,9 +1326,19 @@ class Project(object):
         return 0
 
     def env_gen(self, packages=None):
-        envs = []
+        # All the packages with their dependencies, in one pass over the
+        # dependency graph
+        graph = self.get_dep_graph()
+        pkgs = set()
         for pkg in self.get_buildable_packages(packages=packages):
-            envs += pkg.env_get()
+            pkgs.add(pkg)
+            pkgs.update(graph.get_closure(pkg))
+
+        envs = []
+        for pkg in graph.sort(pkgs):
+            sourceme = pkg.get_sourceme()
+            if sourceme is not None:
+                envs.append(sourceme)
 
         defs = []
         config_string = os.environ.get('PULP_CURRENT_CONFIG')
@@ -1133,17 +1348,17 @@ class Project(object):
         if config_string_args is not None:
             defs.append(['PULP_CURRENT_CONFIG_ARGS', config_string_args])
 
-        with open('sourceme.sh', 'w') as file:
-            for env_var in defs:
-                file.write('export %s=%s\n' % (env_var[0], env_var[1]))
-            for env in envs:
-                file.write('if [ -e %s.sh ]; then source %s.sh; fi\n' % (env, env))
+        sh_lines = []
+        csh_lines = []
+        for env_var in defs:
+            sh_lines.append('export %s=%s\n' % (env_var[0], env_var[1]))
+            csh_lines.append('setenv %s %s\n' % (env_var[0], env_var[1]))
+        for env in envs:
+            sh_lines.append('if [ -e %s.sh ]; then source %s.sh; fi\n' % (env, env))
+            csh_lines.append('if ( -e %s.csh ) source %s.csh\n' % (env, env))
 
-        with open('sourceme.csh', 'w') as file:
-            for env_var in defs:
-                file.write('setenv %s %s\n' % (env_var[0], env_var[1]))
-            for env in envs:
-                file.write('if ( -e %s.csh ) source %s.csh\n' % (env, env))
+        plptools_cache.update_file('sourceme.sh', ''.join(sh_lines))
+        plptools_cache.update_file('sourceme.csh', ''.join(csh_lines))
 
         self.cmd_callback()
         return 0
@@ -1155,6 +1370,8 @@ class Project(object):
         return 0
 
     def update(self, packages=None, groups=None, modules=None):
+        # The modules may have been modified since they were last queried
+        plptools_git.metadata.invalidate()
         for pkg in self.get_buildable_packages(packages=packages):
             pkg.update(groups=groups, modules=modules)
         reactor.callLater(0, self.cmd_callback)
@@ -1184,34 +1401,22 @@ class Project(object):
         if self.config.get('build_steps') is not None:
             steps = self.config.get('build_steps').get('build')
 
-        built_list = []
-
-        for pkg in self.get_buildable_packages(packages=packages):
-
-            if deps:
-                for dep in pkg.get_all_build_deps() + pkg.get_all_exec_deps():
-                    if not dep in built_list and dep.is_active():
-                        built_list.append(dep)
-
-                        dep.build(self.builder, cmd_group, configs=self.configs,
-                                  groups=groups, modules=modules, steps=steps)
-
-            if not pkg in built_list:
-                built_list.append(pkg)
-
-                pkg.build(self.builder, cmd_group, configs=self.configs,
-                          groups=groups, modules=modules, steps=steps)
+        for pkg in self.get_packages_with_deps(packages=packages, deps=deps):
+            pkg.build(self.builder, cmd_group, configs=self.configs,
+                      groups=groups, modules=modules, steps=steps)
 
         cmd_group.set_finished()
 
         return 0
 
     def sync(self, packages=None, groups=None, modules=None):
+        cmd_group = Cmd_group(self.cmd_callback)
+
         for pkg in self.get_buildable_packages(packages=packages):
 
-                pkg.sync(groups=groups, modules=modules)
+                pkg.sync(self.builder, cmd_group, groups=groups, modules=modules)
 
-        self.cmd_callback()
+        cmd_group.set_finished()
 
         return 0
 
@@ -1250,21 +1455,9 @@ class Project(object):
         if self.config.get('build_steps') is not None:
             steps = self.config.get('build_steps').get('clean')
 
-        built_list = []
-
-        for pkg in self.get_buildable_packages(packages=packages):
-
-            if deps:
-                for dep in pkg.get_all_build_deps() + pkg.get_all_exec_deps():
-                    if not dep in built_list and dep.is_active():
-                        built_list.append(dep)
-
-                        dep.clean(self.builder, cmd_group, configs=self.configs,
-                                  groups=groups, modules=modules, steps=steps)
-
-            if not pkg in built_list:
-                pkg.clean(self.builder, cmd_group, configs=self.configs,
-                          groups=groups, modules=modules, steps=steps)
+        for pkg in self.get_packages_with_deps(packages=packages, deps=deps):
+            pkg.clean(self.builder, cmd_group, configs=self.configs,
+                      groups=groups, modules=modules, steps=steps)
 
         cmd_group.set_finished()
 
@@ -1324,18 +1517,9 @@ class Project(object):
 
         cmd_group = Cmd_group(self.cmd_callback)
 
-        built_list = []
-        for pkg in self.get_buildable_packages(packages=packages):
-            if deps:
-                for dep in pkg.get_all_build_deps() + pkg.get_all_exec_deps():
-                    if not dep in built_list and dep.is_active():
-                        built_list.append(dep)
-                        if cmd_func(dep, command, self.builder, cmd_group, groups=groups, modules=modules, *kargs, **kwargs) != 0:
-                            return -1
-
-            if not pkg in built_list:
-                if cmd_func(pkg, command, self.builder, cmd_group, groups=groups, modules=modules, *kargs, **kwargs) != 0:
-                    return -1
+        for pkg in self.get_packages_with_deps(packages=packages, deps=deps):
+            if cmd_func(pkg, command, self.builder, cmd_group, groups=groups, modules=modules, *kargs, **kwargs) != 0:
+                return -1
 
         cmd_group.set_finished()
 
@@ -19,13 +19,148 @@
 from twisted.internet import protocol, reactor, endpoints
 import os
 import shlex
+import signal
 import sys
+import heapq
+import time
+import re
+import collections
+import plptools_cache
+from prettytable import PrettyTable
+
+
+class Log_sink(object):
+  # Output of a command. Only the last max_size characters are kept in
+  # memory, the full output goes to a file when a path is given.
+
+  def __init__(self, max_size=1024*1024, path=None):
+    self.max_size = max_size
+    self.path = path
+    self.chunks = collections.deque()
+    self.size = 0
+    self.total_size = 0
+    self.file = None
+
+  def append(self, data):
+    if self.path is not None:
+      try:
+        if self.file is None:
+          os.makedirs(os.path.dirname(self.path), exist_ok=True)
+          self.file = open(self.path, 'w')
+        self.file.write(data)
+      except OSError as e:
+        # Go on with the output kept in memory, only the part which does
+        # not fit is lost
+        sys.stderr.write('Unable to write command log %s: %s\n' % (self.path, e))
+        self.close()
+        self.path = None
+
+    self.chunks.append(data)
+    self.size += len(data)
+    self.total_size += len(data)
+
+    while self.size > self.max_size and len(self.chunks) > 1:
+      self.size -= len(self.chunks.popleft())
+
+  def close(self):
+    if self.file is not None:
+      try:
+        self.file.close()
+      except OSError:
+        pass
+      self.file = None
+
+  def get_tail(self, size=None):
+    if size is None:
+      size = self.max_size
+    # Only join the chunks which are needed to get the tail
+    chunks = []
+    chunks_size = 0
+    for chunk in reversed(self.chunks):
+      if chunks_size >= size:
+        break
+      chunks.append(chunk)
+      chunks_size += len(chunk)
+    return ''.join(reversed(chunks))[-size:]
+
+  def is_truncated(self):
+    return self.total_size > self.size
+
+  def replay(self, out=sys.stdout):
+    if self.path is not None and os.path.exists(self.path):
+      self.close()
+      with open(self.path, 'r') as file:
+        for chunk in iter(lambda: file.read(1024*1024), ''):
+          out.write(chunk)
+    else:
+      if self.is_truncated():
+        out.write('[... %d characters dropped ...]\n' % (self.total_size - self.size))
+      out.write(self.get_tail())
+
+  def __str__(self):
+    return self.get_tail()
+
+
+class Local_executor(object):
+  # Executes the commands on this machine. Other executors must provide the
+  # same interface and report the output and the end of the commands through
+  # their ProcessProtocol methods.
+
+  def get_capacity(self):
+    # None means the builder budget is not limited by the executor
+    return None
+
+  def spawn(self, cmd):
+    args = shlex.split(cmd.cmd)
+    cmd.p = reactor.spawnProcess(cmd, path=cmd.path, executable=args[0], args=args, usePTY=True, env=cmd.env)
+    cmd.gid = os.getpgid(cmd.p.pid)
+    cmd.pid = cmd.p.pid
+
+  def kill(self, cmd):
+    os.killpg(cmd.pid, signal.SIGKILL)
+
+  def close(self):
+    pass
+
+
+class Retry_policy(object):
+  # Tells if a failed command should be executed again. Retries can be
+  # restricted to some exit codes or to outputs matching some patterns.
+  # The delay before attempt N+1 is delay * backoff^(N-1).
+
+  def __init__(self, max_attempts=1, delay=5.0, backoff=2.0, exit_codes=None, patterns=None):
+    self.max_attempts = max_attempts
+    self.delay = delay
+    self.backoff = backoff
+    self.exit_codes = exit_codes
+    self.patterns = []
+    if patterns is not None:
+      for pattern in patterns:
+        self.patterns.append(re.compile(pattern))
+
+  def get_delay(self, attempt):
+    return self.delay * self.backoff ** (attempt - 1)
+
+  def should_retry(self, cmd):
+    if cmd.attempt >= self.max_attempts:
+      return False
+    if self.exit_codes is not None and cmd.exit_code not in self.exit_codes:
+      return False
+    if len(self.patterns) != 0:
+      output = cmd.log.get_tail()
+      for pattern in self.patterns:
+        if pattern.search(output) is not None:
+          return True
+      return False
+    return True
+
 
 class Builder_command(protocol.ProcessProtocol):
 
-  def __init__(self, name=None, cmd=None, path=None, deps=[], env={}, callback=None, *kargs, **kwargs):
+  def __init__(self, name=None, cmd=None, path=None, deps=[], env={}, callback=None, cache_key=None, output_dir=None,
+      cpu=1, memory=0, exclusive=False, retry=None, *kargs, **kwargs):
     super(Builder_command, self).__init__()
-    self.log = ''
+    self.log = Log_sink()
     self.closed = False
     self.status = False
     self.cmd = cmd
@@ -39,6 +174,42 @@ class Builder_command(protocol.ProcessProtocol):
     self.builder_callback = None
     self.env = env
     self.dump_log = False
+    # Estimated duration of the command, used by the builder to compute
+    # the critical path going through it. Proxy jobs cost nothing.
+    self.cost = 1.0 if cmd is not None else 0.0
+    self.enqueue_time = None
+    self.ready_time = None
+    self.start_time = None
+    self.end_time = None
+    self.exit_code = None
+    self.slot = None
+    self.output_size = 0
+    # Static part of the cache key, None if the command can't be cached,
+    # and directory where the command installs its outputs
+    self.cache_key = cache_key
+    self.output_dir = output_dir
+    self.action_key = None
+    self.output_digest = None
+    self.snapshot = None
+    self.cached = False
+    # Set when another command wrote to the same output directory while
+    # this one was running, its outputs can't be told apart then
+    self.overlapped = False
+    self.jobserver_token = False
+    # Resources needed by the command, the builder does not start it until
+    # they are available. The cpu weight is in number of job slots and the
+    # memory in MB. An exclusive command runs alone.
+    self.cpu = cpu
+    self.memory = memory
+    self.exclusive = exclusive
+    self.blocked_since = None
+    # Set by the builder when it goes on after failures, in which case this
+    # command is skipped if one of its dependencies fails
+    self.keep_going = False
+    self.skipped = False
+    # Retry policy of this command, the builder one is used if None
+    self.retry = retry
+    self.attempt = 1
     self.register_deps()
 
   def set_callback(self, callback=None, *kargs, **kwargs):
@@ -69,10 +240,19 @@ class Builder_command(protocol.ProcessProtocol):
   def register_dep(self, dep):
     self.up_deps.append(dep)
 
+  def get_output_deps(self):
+    return self.deps
+
   def appendOutput(self, data):
     if self.stdout:
       sys.stdout.write(data)
-    self.log += data
+    self.output_size += len(data)
+    self.log.append(data)
+
+  def get_duration(self):
+    if self.start_time is None or self.end_time is None:
+      return None
+    return self.end_time - self.start_time
 
   def outReceived(self, data):
     self.appendOutput(data.decode('utf-8', errors='ignore'))
@@ -82,32 +262,60 @@ class Builder_command(protocol.ProcessProtocol):
 
   def __handle_end(self):
     self.closed = True
+    self.end_time = time.time()
+    self.log.close()
 
     if self.stdout_cached:
-      print (self.log)
+      self.log.replay()
 
     if self.builder_callback != None:
       self.builder_callback(self)
+      # The builder reopens the command when it is retried, only the final
+      # attempt is reported
+      if not self.closed:
+        return
+
+    if self.callback != None:
+      self.callback(*self.kargs, **self.kwargs)
+
+  def reset(self):
+    # Prepare the command to be executed again after a failure
+    self.closed = False
+    self.status = False
+    self.exit_code = None
+    self.start_time = None
+    self.end_time = None
+    self.output_size = 0
+    self.attempt += 1
+
+  def skip(self):
+    self.closed = True
+    self.skipped = True
+    self.status = False
 
     if self.callback != None:
       self.callback(*self.kargs, **self.kwargs)
 
   def close(self, kill=False):
     if self.closed: return True
-    os.killpg(self.pid, signal.SIGKILL)
+    self.executor.kill(self)
 
-  def run(self, log, stdout, stdout_cached, callback):
+  def run(self, log, stdout, stdout_cached, callback, executor=None):
     self.dump_log = log
     self.stdout = stdout
     self.stdout_cached = stdout_cached
     self.builder_callback = callback
-    if self.cmd != None:
+    self.executor = executor if executor is not None else Local_executor()
+    self.start_time = time.time()
+    if self.cached:
+      print ()
+      print ('\033[1m' + '%s' % self.name + '\033[0m' + ': restored from cache')
+      self.status = True
+      self.__handle_end()
+    elif self.cmd != None:
       print ()
       print ('\033[1m' + '%s' % self.name + '\033[0m' + ': %s' % (self.cmd))
-      args = shlex.split(self.cmd)
-      self.p = reactor.spawnProcess(self,path=self.path, executable=args[0], args=args, usePTY=True, env=self.env)
-      self.gid = os.getpgid(self.p.pid)
-      self.pid = self.p.pid
+      self.executor.spawn(self)
     else:
       self.status = True
       self.__handle_end()
@@ -118,17 +326,27 @@ class Builder_command(protocol.ProcessProtocol):
       self.status = False
     else:
       self.appendOutput('Reached EOF with exit status ' + str(reason.value.exitCode) + '\n')
+      self.exit_code = reason.value.exitCode
       self.status = reason.value.exitCode == 0
 
     self.__handle_end()
 
 class Builder(object):
 
-  def __init__(self, nb_threads=1, log=None, stdout=False, stdout_cached=False):
+  def __init__(self, nb_threads=1, log=None, stdout=False, stdout_cached=False, history=None, cache=None,
+      log_dir=None, log_max_size=1024*1024, log_tail_size=64*1024, jobserver=None, trace=None,
+      load_monitor=None, max_memory=None, backfill_timeout=60, keep_going=False, retry_policy=None,
+      executor=None):
 
     self.nb_threads = nb_threads
+    self.stopped = False
     self.runnings = []
+    # Ready commands, kept as a heap ordered by decreasing critical path
     self.pendings = []
+    self.critical_paths = {}
+    self.graph_dirty = False
+    self.dispatch_scheduled = False
+    self.nb_enqueued = 0
     self.commands = {}
     self.empty_callback = None
     self.nb_pendings = 0
@@ -136,50 +354,429 @@ class Builder(object):
     self.stdout = stdout
     self.stdout_cached = stdout_cached
     self.status = 0
+    self.history = history
+    self.cache = cache
+    # Commands currently writing to each output directory, and whether
+    # each of them had no file from a previous build when first used
+    self.output_writers = {}
+    self.clean_output_dirs = {}
+    self.log_dir = log_dir
+    self.log_max_size = log_max_size
+    self.log_tail_size = log_tail_size
+    self.jobserver = jobserver
+    self.trace = trace
+    self.load_monitor = load_monitor
+    # nb_threads is the cpu budget shared by the running commands
+    self.max_memory = max_memory
+    self.backfill_timeout = backfill_timeout
+    self.used_cpu = 0
+    self.used_memory = 0
+    self.nb_running_cmds = 0
+    self.nb_exclusive = 0
+    self.keep_going = keep_going
+    self.retry_policy = retry_policy
+    self.executor = executor if executor is not None else Local_executor()
+    self.all_commands = []
+    self.summary_dumped = False
+    self.slots = []
+    self.remaining_cost = 0.0
+    self.nb_jobs = 0
+    self.nb_jobs_done = 0
+    self.default_cost = None
+    if history is not None:
+      self.default_cost = history.get_default_estimate()
     
+  def get_log_path(self, cmd):
+    if self.log_dir is None or cmd.name is None:
+      return None
+    name = re.sub(r'[^\w.-]+', '_', cmd.name)
+    # Keep the output of the failed attempts
+    if cmd.attempt > 1:
+      name += '.%d' % cmd.attempt
+    return os.path.join(self.log_dir, name + '.log')
+
+  def __get_slot(self):
+    # Lowest free worker slot, only used to show the commands on stable
+    # tracks in the build trace
+    for slot in range(0, len(self.slots)):
+      if not self.slots[slot]:
+        self.slots[slot] = True
+        return slot
+    self.slots.append(True)
+    return len(self.slots) - 1
+
   def run(self, cmd):
     self.runnings.append(cmd)
-    cmd.run(log=self.log, stdout=self.stdout, callback=self.cmd_end, stdout_cached=self.stdout_cached)
+    if cmd.cmd is not None:
+      cmd.slot = self.__get_slot()
+      self.used_cpu += cmd.cpu
+      self.used_memory += cmd.memory
+      self.nb_running_cmds += 1
+      if cmd.exclusive:
+        self.nb_exclusive += 1
+      cmd.log = Log_sink(max_size=self.log_max_size, path=self.get_log_path(cmd))
+      if self.jobserver is not None:
+        # Done here rather than in the module environment so that the
+        # fifo path does not end up in the step cache keys
+        cmd.env = cmd.env.copy()
+        cmd.env['MAKEFLAGS'] = self.jobserver.get_makeflags(cmd.env.get('MAKEFLAGS'))
+    if self.cache is not None and cmd.cmd is not None and cmd.output_dir is not None:
+      if cmd.output_dir not in self.clean_output_dirs:
+        self.clean_output_dirs[cmd.output_dir] = self.cache.is_clean(cmd.output_dir)
+      writers = self.output_writers.setdefault(cmd.output_dir, set())
+      for writer in writers:
+        writer.overlapped = True
+      if len(writers) != 0:
+        cmd.overlapped = True
+      writers.add(cmd)
+      if cmd.cache_key is not None:
+        cmd.action_key = self.cache.get_action_key(cmd)
+        if cmd.action_key is not None:
+          try:
+            cmd.cached = self.cache.restore(cmd)
+          except (OSError, ValueError) as e:
+            # The step is then just executed
+            self.dump_cache_error(cmd, e)
+            cmd.cached = False
+      if not cmd.cached and cmd.snapshot is None:
+        # Remember the state of the install tree to find out what the
+        # command produced
+        cmd.snapshot = plptools_cache.get_tree_snapshot(cmd.output_dir)
+    cmd.run(log=self.log, stdout=self.stdout, callback=self.cmd_end, stdout_cached=self.stdout_cached, executor=self.executor)
+
+  def dump_cache_error(self, cmd, error):
+    # The cache is only an optimization, the build goes on without it
+    print ('\033[93m' + '%s: step cache error, step not cached: %s' % (cmd.name, error) + '\033[0m')
 
   def cmd_end(self, cmd):
 
     self.runnings.remove(cmd)
 
+    if cmd.slot is not None:
+      self.slots[cmd.slot] = False
+      self.used_cpu -= cmd.cpu
+      self.used_memory -= cmd.memory
+      self.nb_running_cmds -= 1
+      if cmd.exclusive:
+        self.nb_exclusive -= 1
+      if self.trace is not None:
+        self.trace.record(cmd)
+
+    if cmd.jobserver_token:
+      cmd.jobserver_token = False
+      self.jobserver.release()
+
+    if cmd.output_dir in self.output_writers:
+      self.output_writers[cmd.output_dir].discard(cmd)
+
+    if not cmd.status and cmd.cmd is not None and self.__should_retry(cmd):
+      self.record(cmd, retried=True)
+      return self.__retry(cmd)
+
+    self.remaining_cost -= cmd.cost
+    if cmd.cmd is not None:
+      self.record(cmd)
+
+    if self.cache is not None:
+      if cmd.cmd is None:
+        # Proxy jobs just forward the outputs of their dependencies
+        digests = self.cache.get_deps_digests(cmd)
+        cmd.output_digest = plptools_cache.get_digest(digests) if digests is not None else None
+      elif cmd.status and cmd.snapshot is not None:
+        # The outputs are not known if the files written by the other
+        # commands were mixed with them or if the command may have skipped
+        # some already installed by a previous build
+        try:
+          self.cache.store(cmd, cmd.snapshot,
+            complete=not cmd.overlapped and self.clean_output_dirs[cmd.output_dir])
+        except (OSError, ValueError) as e:
+          self.dump_cache_error(cmd, e)
+          cmd.output_digest = None
+        cmd.snapshot = None
+
     if not cmd.status:
-      return self.stop(-1)
+      self.dump_failure(cmd)
+      if not self.keep_going:
+        return self.stop(-1)
+
+      # Only the commands depending on the failed one are dropped, the
+      # final status is reported once everything else is done
+      self.status = -1
+      self.nb_pendings -= 1
+      self.skip_dependents(cmd)
+      return self.dispatch()
 
     self.nb_pendings -= 1
 
     for dep in cmd.up_deps:
-      if dep.end_of_dep():
+      if dep.end_of_dep() and not dep.skipped:
         self.enqueue_ready(dep)
 
     if self.nb_pendings == 0 and self.empty_callback != None:
       self.empty_callback()
       self.empty_callback = None
 
-    if len(self.pendings) > 0 and len(self.runnings) <   self.nb_threads:
-      cmd = self.pendings.pop()
-      self.run(cmd)
+    self.dispatch()
 
 
 
+  def __should_retry(self, cmd):
+    policy = cmd.retry if cmd.retry is not None else self.retry_policy
+    return policy is not None and policy.should_retry(cmd)
+
+  def __retry(self, cmd):
+    policy = cmd.retry if cmd.retry is not None else self.retry_policy
+    delay = policy.get_delay(cmd.attempt)
+    print ('\033[93m' + '%s failed (attempt %d/%d), retrying in %.1fs' % (cmd.name, cmd.attempt, policy.max_attempts, delay) + '\033[0m')
+    cmd.reset()
+    reactor.callLater(delay, self.enqueue_ready, cmd)
+    self.dispatch()
+
+  def skip_dependents(self, cmd):
+    stack = list(cmd.up_deps)
+    while len(stack) > 0:
+      dep = stack.pop()
+      if dep.skipped:
+        continue
+      self.nb_pendings -= 1
+      self.remaining_cost -= dep.cost
+      dep.skip()
+      stack += dep.up_deps
+
+  def dump_summary(self):
+    if self.summary_dumped:
+      return
+    self.summary_dumped = True
+
+    table = PrettyTable(['Command', 'Status', 'Duration'])
+    table.align['Command'] = 'l'
+    table.align['Duration'] = 'r'
+
+    rows = {'failed': [], 'skipped': [], 'cached': [], 'success': [], 'pending': []}
+    for cmd in self.all_commands:
+      if cmd.cmd is None:
+        continue
+      if cmd.skipped:
+        status = 'skipped'
+      elif not cmd.closed:
+        status = 'pending'
+      elif not cmd.status:
+        status = 'failed'
+      elif cmd.cached:
+        status = 'cached'
+      else:
+        status = 'success'
+      duration = cmd.get_duration()
+      rows[status].append([cmd.name, status, '%.1fs' % duration if duration is not None else ''])
+
+    for status in ['failed', 'skipped', 'pending', 'cached', 'success']:
+      for row in rows[status]:
+        table.add_row(row)
+
+    print ()
+    print (table)
+    print ('%d failed, %d skipped, %d succeeded' % (len(rows['failed']), len(rows['skipped']), len(rows['success']) + len(rows['cached'])))
+
+  def dump_failure(self, cmd):
+    # The output was not visible so far, show at least its end
+    if not self.stdout and not self.stdout_cached:
+      tail = cmd.log.get_tail(self.log_tail_size)
+      print ()
+      print ('\033[1m' + '%s' % cmd.name + '\033[0m' + ': last %d characters of output:' % len(tail))
+      sys.stdout.write(tail)
+
+    if cmd.log.path is not None:
+      print ('\033[91m' + 'Full output of %s available in %s' % (cmd.name, cmd.log.path) + '\033[0m')
+
   def get_command(self, name):
     return self.commands.get(name)
 
-  def enqueue_ready(self, cmd):
+  def get_cost(self, cmd):
+    # Estimated duration in seconds when the history knows about the command
+    if cmd.cmd is None:
+      return 0.0
+    if self.history is not None:
+      median = self.history.get_median(cmd.name)
+      if median is not None:
+        return median
+    if self.default_cost is not None:
+      return self.default_cost
+    return 1.0
+
+  def get_eta(self):
+    # The build can't end before the longest remaining chain, nor before
+    # the remaining work is spread over all the workers
+    eta = self.remaining_cost / self.nb_threads
+    for entry in self.pendings:
+      eta = max(eta, -entry[0])
+    return eta
+
+  def record(self, cmd, retried=False):
+    if not retried:
+      self.nb_jobs_done += 1
+
+    # Restored commands say nothing about the real duration of the step
+    if self.history is None or cmd.cached:
+      return
+
+    ratio = self.history.record(cmd.name, cmd.get_duration(), cmd.status, cmd.output_size, attempt=cmd.attempt)
+    if ratio is not None:
+      print ('\033[93m' + 'WARNING: %s took %.1fs, %.1fx slower than its median' % (cmd.name, cmd.get_duration(), ratio) + '\033[0m')
+
+    if self.default_cost is not None:
+      print ('\033[1m' + 'Progress' + '\033[0m' + ': %d/%d jobs done, ETA %ds' % (self.nb_jobs_done, self.nb_jobs, self.get_eta()))
+
+  def get_critical_path(self, cmd):
+    # The critical path of a command is its own cost plus the longest
+    # critical path of the commands waiting for it. The graph can be deep,
+    # so it is walked iteratively and memoized until it changes.
+    if cmd in self.critical_paths:
+      return self.critical_paths[cmd]
+
+    stack = [cmd]
+    while len(stack) > 0:
+      current = stack[-1]
+      if current in self.critical_paths:
+        stack.pop()
+        continue
+
+      missing = [dep for dep in current.up_deps if dep not in self.critical_paths]
+      if len(missing) != 0:
+        stack += missing
+        continue
+
+      stack.pop()
+      path = 0.0
+      for dep in current.up_deps:
+        path = max(path, self.critical_paths[dep])
+      self.critical_paths[current] = current.cost + path
+
+    return self.critical_paths[cmd]
+
+  def __push_pending(self, cmd):
+    heapq.heappush(self.pendings, (-self.get_critical_path(cmd), cmd.enqueue_id, cmd))
+
+  def __update_priorities(self):
+    # New commands were enqueued since the priorities were computed, which
+    # can lengthen the critical path of the pending ones
+    self.critical_paths = {}
+    commands = [entry[2] for entry in self.pendings]
+    self.pendings = []
+    for cmd in commands:
+      self.__push_pending(cmd)
+    self.graph_dirty = False
+
+  def __schedule_dispatch(self, delay=0):
+    if not self.dispatch_scheduled:
+      self.dispatch_scheduled = True
+      reactor.callLater(delay, self.dispatch)
+
+  def __fits(self, cmd):
+    # A command needing more than the whole budget can still run alone
+    if self.nb_running_cmds == 0:
+      return True
+    if cmd.exclusive or self.nb_exclusive != 0:
+      return False
+    if self.used_cpu + cmd.cpu > self.nb_threads:
+      return False
+    if self.max_memory is not None and self.used_memory + cmd.memory > self.max_memory:
+      return False
+    return True
+
+  def dispatch(self):
+    self.dispatch_scheduled = False
+
+    if self.graph_dirty:
+      self.__update_priorities()
+
+    if self.load_monitor is not None:
+      self.nb_threads = self.load_monitor.get_nb_threads(self.used_cpu)
+    elif self.executor.get_capacity() is not None:
+      # Remote workers report how many commands they can execute
+      self.nb_threads = self.executor.get_capacity()
+
+    skipped = []
+    retry_delay = None
+
+    while len(self.pendings) > 0:
+      cmd = self.pendings[0][2]
+
+      if cmd.cmd is not None:
+        if self.used_cpu >= self.nb_threads and self.nb_running_cmds != 0:
+          break
+
+        if not self.__fits(cmd):
+          # Let the next commands use the free resources, unless the most
+          # critical one has been waiting for too long, in which case
+          # the running ones are drained to make room for it
+          if len(skipped) == 0:
+            if cmd.blocked_since is None:
+              cmd.blocked_since = time.time()
+            elif time.time() - cmd.blocked_since > self.backfill_timeout:
+              break
+          skipped.append(heapq.heappop(self.pendings))
+          continue
+
+        # Don't start anything while the machine is short of memory, unless
+        # nothing is running, as waiting would then not free anything
+        if self.load_monitor is not None and self.nb_running_cmds != 0 and \
+            not self.load_monitor.has_free_memory():
+          retry_delay = self.load_monitor.period
+          break
+
+        # Real commands need a token from the jobserver pool, which may be
+        # exhausted by the makes already running. The pool is polled until
+        # they give some back.
+        if self.jobserver is not None:
+          if not self.jobserver.acquire():
+            retry_delay = 0.1
+            break
+          cmd.jobserver_token = True
+
+      heapq.heappop(self.pendings)
+      cmd.blocked_since = None
+      self.run(cmd)
 
-    if len(self.runnings) >= self.nb_threads:
+    for entry in skipped:
+      heapq.heappush(self.pendings, entry)
 
-      self.pendings.append(cmd)
+    if retry_delay is not None:
+      self.__schedule_dispatch(retry_delay)
       return
 
-    self.run(cmd)
+    # The load may go down while no command ends, check it again later
+    if self.load_monitor is not None and len(self.pendings) > 0:
+      self.__schedule_dispatch(self.load_monitor.period)
+
+  def enqueue_ready(self, cmd):
+
+    cmd.ready_time = time.time()
+
+    if self.graph_dirty:
+      self.pendings.append((0, cmd.enqueue_id, cmd))
+    else:
+      self.__push_pending(cmd)
+
+    # Commands are not started right away so that all commands enqueued
+    # in the same reactor iteration are known when choosing which one
+    # to start first
+    self.__schedule_dispatch()
 
 
   def enqueue(self, cmd):
 
     self.nb_pendings += 1
+    self.nb_enqueued += 1
+    cmd.enqueue_id = self.nb_enqueued
+    cmd.enqueue_time = time.time()
+    cmd.keep_going = self.keep_going
+    self.graph_dirty = True
+    self.all_commands.append(cmd)
+
+    cmd.cost = self.get_cost(cmd)
+    self.remaining_cost += cmd.cost
+    if cmd.cmd is not None:
+      self.nb_jobs += 1
 
     if cmd.name != None:
       self.commands[cmd.name] = cmd
@@ -193,7 +790,26 @@ class Builder(object):
       self.enqueue_ready(cmd)
 
   def stop(self, status):
+    # The builder may already have been stopped by a failure when the
+    # commands callbacks ask for it, and the reactor can be stopped only once
+    if self.stopped:
+      return
+    self.stopped = True
     self.status = status
 
+    if self.keep_going:
+      self.dump_summary()
+
+    if self.history is not None:
+      self.history.save()
+
+    if self.jobserver is not None:
+      self.jobserver.close()
+
+    self.executor.close()
+
+    if self.trace is not None:
+      self.trace.save()
+
     if reactor.running: 
       reactor.stop()
@@ -0,0 +1,230 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import os.path
+import json
+import hashlib
+import shutil
+
+
+def get_digest(items):
+    m = hashlib.sha1()
+    for item in items:
+        m.update(str(item).encode('utf-8'))
+        m.update(b'\0')
+    return m.hexdigest()
+
+
+def get_file_digest(path):
+    m = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024*1024), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def update_file(path, content):
+    """
+    Write the file only if its content changed, so that its modification
+    time does not trigger anything depending on it. Return True if written.
+    """
+    content = content.encode('utf-8')
+    try:
+        if get_file_digest(path) == hashlib.sha1(content).hexdigest():
+            return False
+    except OSError:
+        pass
+
+    # Readers never see a partially written file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fd:
+        fd.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+
+def get_tree_snapshot(path):
+    # Cheap view of a directory used to detect which files a step produced
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(file_path)
+            except OSError:
+                continue
+            snapshot[os.path.relpath(file_path, path)] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class Step_cache(object):
+    """
+    Content-addressed cache of build step outputs.
+
+    An action key is computed from everything the step depends on. The
+    files the step wrote into the install tree are stored once by content
+    under objects/ and the action entry under actions/ lists them, so that
+    the step can be replayed by copying the files back.
+
+    A step which finds its outputs already installed may not write them
+    again, so steps are only stored when they are executed in an install
+    tree which had no file from a previous build. The files given in
+    generated_files are the ones not installed by the steps.
+    """
+
+    def __init__(self, path, generated_files=[]):
+        self.path = path
+        self.generated_files = set(generated_files)
+        self.objects_path = os.path.join(path, 'objects')
+        self.actions_path = os.path.join(path, 'actions')
+        for dir_path in [self.objects_path, self.actions_path]:
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                pass
+
+    def is_clean(self, path):
+        for rel_path in get_tree_snapshot(path).keys():
+            if rel_path not in self.generated_files:
+                return False
+        return True
+
+    def get_deps_digests(self, cmd):
+        # Digests of the upstream outputs, None if some are not known.
+        # Commands not installing anything, like git ones, are not taken
+        # into account.
+        digests = []
+        for dep in cmd.get_output_deps():
+            if dep.cmd is None or dep.output_dir is not None:
+                if dep.output_digest is None:
+                    return None
+                digests.append(dep.output_digest)
+        return digests
+
+    def get_action_key(self, cmd):
+        # The static part of the key is computed when the command is
+        # created, the digests of the upstream outputs are only known once
+        # all dependencies are finished
+        digests = self.get_deps_digests(cmd)
+        if digests is None:
+            return None
+        return get_digest([cmd.cache_key] + digests)
+
+    def __get_action_path(self, key):
+        return os.path.join(self.actions_path, key[0:2], key + '.json')
+
+    def __get_object_path(self, digest):
+        return os.path.join(self.objects_path, digest[0:2], digest)
+
+    def lookup(self, cmd):
+        action_path = self.__get_action_path(cmd.action_key)
+        if not os.path.exists(action_path):
+            return None
+        try:
+            with open(action_path, 'r') as fd:
+                return json.load(fd)
+        except (ValueError, OSError):
+            return None
+
+    def restore(self, cmd):
+        """
+        Copy back the outputs recorded for the command, return False if the
+        action is not in the cache.
+        """
+        action = self.lookup(cmd)
+        if action is None:
+            return False
+
+        for rel_path, output in action['outputs'].items():
+            if not os.path.exists(self.__get_object_path(output['digest'])):
+                return False
+
+        for rel_path, output in action['outputs'].items():
+            file_path = os.path.join(cmd.output_dir, rel_path)
+            try:
+                os.makedirs(os.path.dirname(file_path))
+            except OSError:
+                pass
+            if os.path.lexists(file_path):
+                os.unlink(file_path)
+            shutil.copyfile(self.__get_object_path(output['digest']), file_path)
+            os.chmod(file_path, output['mode'])
+
+        cmd.output_digest = action['digest']
+        return True
+
+    def store(self, cmd, before, complete=True):
+        """
+        Record the files which changed in the install tree since the
+        snapshot taken before the command was started. complete tells if
+        these are all the outputs of the command, otherwise they are not
+        known and nothing is recorded.
+        """
+        cmd.output_digest = None
+        if not complete:
+            return
+
+        after = get_tree_snapshot(cmd.output_dir)
+
+        outputs = {}
+        for rel_path, stat in after.items():
+            if before.get(rel_path) == stat:
+                continue
+            file_path = os.path.join(cmd.output_dir, rel_path)
+            if os.path.islink(file_path) or not os.path.isfile(file_path):
+                continue
+            digest = get_file_digest(file_path)
+            object_path = self.__get_object_path(digest)
+            if not os.path.exists(object_path):
+                try:
+                    os.makedirs(os.path.dirname(object_path))
+                except OSError:
+                    pass
+                # Builds sharing the cache may store the same object
+                tmp_path = '%s.%d.tmp' % (object_path, os.getpid())
+                shutil.copyfile(file_path, tmp_path)
+                os.replace(tmp_path, object_path)
+            outputs[rel_path] = {
+                'digest': digest,
+                'mode': os.stat(file_path).st_mode & 0o7777
+            }
+
+        # Nothing tells apart the commands which did not install anything,
+        # the ones depending on them can't be cached
+        if len(outputs) == 0:
+            return
+
+        digests = []
+        for rel_path in sorted(outputs.keys()):
+            digests += [rel_path, outputs[rel_path]['digest']]
+        cmd.output_digest = get_digest(digests)
+
+        # Commands which can't be cached still get their output digest so
+        # that the commands depending on them see when their outputs change
+        if cmd.action_key is None:
+            return
+
+        action_path = self.__get_action_path(cmd.action_key)
+        try:
+            os.makedirs(os.path.dirname(action_path))
+        except OSError:
+            pass
+        tmp_path = '%s.%d.tmp' % (action_path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump({'name': cmd.name, 'digest': cmd.output_digest,
+                       'outputs': outputs}, fd)
+        os.replace(tmp_path, action_path)
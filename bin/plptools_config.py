@@ -0,0 +1,120 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import os.path
+import sys
+import types
+import marshal
+import hashlib
+import importlib.util
+import subprocess
+
+
+# Distributor IDs reported by lsb_release for the os-release IDs, as the
+# artifacts are named after them
+LSB_DISTRIBUTORS = {
+    'ubuntu': 'Ubuntu',
+    'debian': 'Debian',
+    'linuxmint': 'LinuxMint',
+    'centos': 'CentOS',
+    'fedora': 'Fedora',
+    'rhel': 'RedHatEnterpriseServer',
+    'rocky': 'Rocky',
+    'almalinux': 'AlmaLinux',
+    'opensuse-leap': 'openSUSE',
+    'arch': 'Arch'
+}
+
+
+def read_os_release(path='/etc/os-release'):
+    result = {}
+    with open(path, 'r') as fd:
+        for line in fd.readlines():
+            line = line.strip()
+            if line.startswith('#') or line.find('=') == -1:
+                continue
+            key, value = line.split('=', 1)
+            result[key] = value.strip('"\'')
+    return result
+
+
+def get_distrib_info():
+    """
+    Return the distributor ID and the release, as lsb_release would give
+    them but without spawning it.
+    """
+    for path in ['/etc/os-release', '/usr/lib/os-release']:
+        try:
+            info = read_os_release(path)
+        except OSError:
+            continue
+        dist_id = info.get('ID', '')
+        return (LSB_DISTRIBUTORS.get(dist_id, dist_id.capitalize()),
+                info.get('VERSION_ID', ''))
+
+    # Very old distributions without os-release
+    try:
+        output = subprocess.check_output(
+            ['lsb_release', '-si', '-sr'], universal_newlines=True).split()
+    except (OSError, subprocess.CalledProcessError):
+        return '', ''
+    return output[0] if len(output) > 0 else '', output[1] if len(output) > 1 else ''
+
+
+def load_config_module(path, name, cache_dir=None):
+    """
+    Execute a python configuration file and return it as a module.
+    When cache_dir is given, the compiled code is kept there and reused as
+    long as the file modification time and size do not change.
+    """
+    stat = os.stat(path)
+    key = [importlib.util.MAGIC_NUMBER.hex(), stat.st_mtime_ns, stat.st_size]
+
+    code = None
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, '%s-%s.pyc' % (
+            os.path.basename(path),
+            hashlib.sha1(os.path.realpath(path).encode('utf-8')).hexdigest()[:12]))
+        try:
+            with open(cache_path, 'rb') as fd:
+                cached_key, cached_code = marshal.load(fd)
+            if cached_key == key:
+                code = cached_code
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    if code is None:
+        with open(path, 'r') as fd:
+            code = compile(fd.read(), path, 'exec')
+
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = cache_path + '.%d.tmp' % os.getpid()
+                with open(tmp_path, 'wb') as fd:
+                    marshal.dump([key, code], fd)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # The cache is only an optimization
+                pass
+
+    module = types.ModuleType(name)
+    module.__file__ = path
+    sys.modules[name] = module
+    exec(code, module.__dict__)
+    return module
@@ -27,6 +27,7 @@ class Cmd_group(object):
         self.kargs = kargs
         self.kwargs = kwargs
         self.status = True
+        self.keep_going = False
 
     def set_callback(self, callback=None, *kargs, **kwargs):
         self.callback = callback
@@ -41,7 +42,10 @@ class Cmd_group(object):
 
         if command is not None:
             self.status = self.status and command.status
-        if not self.status or self.callback is not None and self.enqueued == 0 and self.finished:
+            # When the builder goes on after failures, wait for all the
+            # commands instead of reporting the failure right away
+            self.keep_going = self.keep_going or command.keep_going
+        if not self.status and not self.keep_going or self.callback is not None and self.enqueued == 0 and self.finished:
             self.callback(*self.kargs, **self.kwargs)
 
     def set_finished(self):
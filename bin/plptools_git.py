@@ -0,0 +1,123 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import subprocess
+import threading
+import concurrent.futures
+
+
+class Git_info(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.head = None
+        self.tags = []
+        self.modified = None
+        self.error = None
+
+        if not os.path.exists(path):
+            return
+
+        try:
+            # HEAD and the refs pointing to it in one go
+            output = subprocess.check_output(
+                ['git', 'log', '-n', '1', '--format=format:%H%n%D'],
+                cwd=path).decode('utf-8').split('\n')
+        except subprocess.CalledProcessError as e:
+            # The state of the directory is not known, which must not be
+            # taken as a clean checkout
+            self.error = e
+            self.modified = True
+            return
+
+        self.head = output[0]
+        if len(output) > 1:
+            for ref in output[1].split(', '):
+                if ref.startswith('tag: '):
+                    self.tags.append(ref[5:])
+
+        self.modified = subprocess.call(
+            ['git', 'diff-index', '--quiet', 'HEAD', '--'], cwd=path) != 0
+
+
+class Git_metadata(object):
+    """
+    Git state of the module directories, queried once per process.
+    The paths registered beforehand are all queried in parallel the first
+    time one of them is needed. Results stay valid until invalidated, which
+    must be done after any git operation modifying the directory.
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.infos = {}
+        self.registered = set()
+        self.lock = threading.Lock()
+
+    def register(self, paths):
+        self.registered.update([os.path.realpath(path) for path in paths])
+
+    def invalidate(self, paths=None):
+        with self.lock:
+            if paths is None:
+                self.infos = {}
+            else:
+                for path in paths:
+                    self.infos.pop(os.path.realpath(path), None)
+
+    def query(self, paths):
+        paths = [path for path in set(paths) if path not in self.infos]
+        if len(paths) == 0:
+            return
+
+        if len(paths) == 1:
+            infos = [Git_info(paths[0])]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self.max_workers, len(paths))) as pool:
+                infos = list(pool.map(Git_info, paths))
+
+        with self.lock:
+            for info in infos:
+                self.infos[info.path] = info
+
+    def get_info(self, path):
+        path = os.path.realpath(path)
+        info = self.infos.get(path)
+        if info is None:
+            # Take the opportunity to get the other ones which are not known
+            # yet, they will most likely be needed too
+            self.query([path] + [registered for registered in self.registered
+                                 if registered not in self.infos])
+            info = self.infos[path]
+        return info
+
+    def get_head(self, path):
+        info = self.get_info(path)
+        if info.error is not None:
+            raise info.error
+        return info.head
+
+    def is_modified(self, path):
+        return self.get_info(path).modified
+
+    def get_tags(self, path):
+        return self.get_info(path).tags
+
+
+# Shared by the whole process
+metadata = Git_metadata()
@@ -0,0 +1,140 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import heapq
+
+
+def get_topological_order(nodes, get_deps):
+    """
+    Return the nodes ordered so that each one comes after its dependencies,
+    keeping the order in which they are given when the dependencies allow
+    it. Dependencies which are not in the list are ignored.
+    """
+    index = {node: node_index for node_index, node in enumerate(nodes)}
+    users = {node: [] for node in nodes}
+    nb_deps = {}
+    for node in nodes:
+        deps = [dep for dep in get_deps(node) if dep in index]
+        nb_deps[node] = len(deps)
+        for dep in deps:
+            users[dep].append(node)
+
+    # Kahn's algorithm, the ready nodes are taken by declaration order
+    ready = [index[node] for node in nodes if nb_deps[node] == 0]
+    heapq.heapify(ready)
+    order = []
+    while len(ready) != 0:
+        node = nodes[heapq.heappop(ready)]
+        order.append(node)
+        for user in users[node]:
+            nb_deps[user] -= 1
+            if nb_deps[user] == 0:
+                heapq.heappush(ready, index[user])
+
+    if len(order) != len(nodes):
+        raise Exception('Dependency cycle detected between: ' + ', '.join(
+            [str(node) for node in nodes if nb_deps[node] != 0]))
+
+    return order
+
+
+class Dependency_graph(object):
+    """
+    Dependency graph computed once from a list of nodes and a function
+    returning the direct dependencies of a node.
+    The topological order puts the dependencies before the nodes depending
+    on them and otherwise follows the order in which the nodes are given.
+    """
+
+    def __init__(self, nodes, get_deps):
+        self.deps = collections.OrderedDict()
+        self.closures = {}
+        self.order = None
+        self.index = None
+
+        # Also take the nodes only reachable through dependencies
+        pending = list(nodes)
+        while len(pending) != 0:
+            node = pending.pop(0)
+            if node in self.deps: continue
+            self.deps[node] = list(get_deps(node))
+            pending += self.deps[node]
+
+    def get_deps(self, node):
+        return self.deps[node]
+
+    def __get_cycle_error(self, path, node):
+        cycle = path[path.index(node):] + [node]
+        return Exception('Dependency cycle detected: ' +
+                         ' -> '.join([str(elem) for elem in cycle]))
+
+    def get_order(self):
+        if self.order is not None:
+            return self.order
+
+        order = []
+        done = set()
+        for root in self.deps.keys():
+            if root in done: continue
+
+            # Iterative depth-first search, a node is appended once all its
+            # dependencies are
+            path = [root]
+            stack = [iter(self.deps[root])]
+            on_path = set([root])
+            while len(stack) != 0:
+                node = next(stack[-1], None)
+                if node is None:
+                    stack.pop()
+                    node = path.pop()
+                    on_path.remove(node)
+                    done.add(node)
+                    order.append(node)
+                elif node in on_path:
+                    raise self.__get_cycle_error(path, node)
+                elif node not in done:
+                    path.append(node)
+                    on_path.add(node)
+                    stack.append(iter(self.deps[node]))
+
+        self.order = order
+        self.index = {node: index for index, node in enumerate(order)}
+        return self.order
+
+    def get_closure(self, node):
+        """
+        Return all the direct and indirect dependencies of a node in
+        topological order.
+        """
+        closure = self.closures.get(node)
+        if closure is None:
+            order = self.get_order()
+            # Dependencies come first in the order, so their closure is
+            # always known when the ones depending on them are computed
+            for elem in order:
+                if elem in self.closures: continue
+                deps = set()
+                for dep in self.deps[elem]:
+                    deps.add(dep)
+                    deps.update(self.closures[dep])
+                self.closures[elem] = self.sort(deps)
+            closure = self.closures[node]
+        return closure
+
+    def sort(self, nodes):
+        self.get_order()
+        return sorted(nodes, key=lambda node: self.index[node])
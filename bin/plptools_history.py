@@ -0,0 +1,109 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import os.path
+import json
+import time
+import statistics
+
+
+class Build_history(object):
+    """
+    On-disk record of the last runs of each builder command, keyed by the
+    command name (e.g. pkg:module:step (config)).
+    Each run stores the wall time, the exit status and the output size.
+    """
+
+    def __init__(self, path, max_runs=20, regression_ratio=2.0,
+                 regression_min_duration=5.0):
+        self.path = path
+        self.max_runs = max_runs
+        self.regression_ratio = regression_ratio
+        # Steps shorter than this are too noisy to be flagged as regressions
+        self.regression_min_duration = regression_min_duration
+        self.steps = {}
+        self.modified = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as fd:
+                    self.steps = json.load(fd).get('steps', {})
+            except (ValueError, OSError):
+                # A corrupted history is not worth failing the build for,
+                # just start from scratch
+                self.steps = {}
+
+    def get_runs(self, name):
+        return self.steps.get(name, [])
+
+    def get_median(self, name):
+        durations = [run['duration'] for run in self.get_runs(name)
+                     if run['status']]
+        if len(durations) == 0:
+            return None
+        return statistics.median(durations)
+
+    def get_default_estimate(self):
+        # Used for commands never seen before
+        medians = [self.get_median(name) for name in self.steps.keys()]
+        medians = [median for median in medians if median is not None]
+        if len(medians) == 0:
+            return None
+        return statistics.median(medians)
+
+    def record(self, name, duration, status, output_size, attempt=1):
+        """
+        Record a new run and return the ratio against the previous rolling
+        median if the step has regressed, otherwise None.
+        """
+        median = self.get_median(name)
+
+        runs = self.steps.setdefault(name, [])
+        runs.append({
+            'date': time.time(),
+            'duration': duration,
+            'status': status,
+            'output_size': output_size,
+            'attempt': attempt
+        })
+        del runs[:-self.max_runs]
+        self.modified = True
+
+        if status and median is not None and \
+                duration >= self.regression_min_duration and \
+                duration > median * self.regression_ratio:
+            return duration / median
+
+        return None
+
+    def save(self):
+        if self.path is None or not self.modified:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+        # Write to a temporary file first so that an interrupted build never
+        # leaves a truncated history behind, one per process as builds may
+        # share the history
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump({'steps': self.steps}, fd)
+        os.replace(tmp_path, self.path)
+        self.modified = False
@@ -0,0 +1,98 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+# First GNU make version understanding fifo jobservers
+MIN_MAKE_VERSION = (4, 4)
+
+
+def get_make_version(make='make'):
+    """
+    Return the version of GNU make as a tuple, or None if it can't be
+    executed or is not GNU make.
+    """
+    try:
+        output = subprocess.check_output(
+            [make, '--version'], stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.match(r'GNU Make (\d+)\.(\d+)', output)
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
+
+
+class Jobserver(object):
+    """
+    GNU make jobserver shared between the builder and the makes it spawns.
+
+    The token pool is a named fifo, as the commands are spawned in a PTY
+    which does not let them inherit pipe descriptors. This needs GNU make
+    4.4 or later in the commands, which is why it is opt-in.
+    Each running builder command holds one token, which is the implicit
+    token of the make it executes. Any additional make job takes another
+    one from the pool, so that the whole build tree never runs more than
+    nb_tokens jobs.
+    """
+
+    def __init__(self, nb_tokens):
+        self.nb_tokens = nb_tokens
+        self.dir = tempfile.mkdtemp(prefix='plpbuild-jobserver-')
+        self.path = os.path.join(self.dir, 'fifo')
+        os.mkfifo(self.path, 0o600)
+        # Opened in read-write mode so that the fifo stays alive even when
+        # no make has it opened
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        os.write(self.fd, b'+' * nb_tokens)
+
+    def acquire(self):
+        if self.fd is None:
+            return False
+        try:
+            return len(os.read(self.fd, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    def release(self):
+        if self.fd is not None:
+            os.write(self.fd, b'+')
+
+    def get_makeflags(self, makeflags=None):
+        # Keep the user flags, but not the ones which would make the
+        # sub-makes ignore our jobserver
+        flags = []
+        if makeflags is not None:
+            for flag in makeflags.split():
+                if flag.startswith('-j') or flag.startswith('--jobserver'):
+                    continue
+                flags.append(flag)
+
+        flags += ['-j%d' % self.nb_tokens, '--jobserver-auth=fifo:%s' % self.path]
+        return ' '.join(flags)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+
+
+def get_load_average():
+    with open('/proc/loadavg', 'r') as fd:
+        return float(fd.read().split()[0])
+
+
+def get_meminfo(name):
+    # In MB
+    with open('/proc/meminfo', 'r') as fd:
+        for line in fd.readlines():
+            if line.startswith(name + ':'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def get_available_memory():
+    return get_meminfo('MemAvailable')
+
+
+def get_total_memory():
+    return get_meminfo('MemTotal')
+
+
+class Load_monitor(object):
+    """
+    Adapts the number of concurrent builder commands to the load of the
+    machine, between min_threads and max_threads.
+    The load coming from other processes is estimated from the load average
+    minus our own running commands, and the cores it leaves are given to
+    the builder.
+    """
+
+    def __init__(self, min_threads=1, max_threads=None, min_free_memory=1024,
+                 period=1.0):
+        self.nb_cores = os.cpu_count() or 1
+        self.min_threads = max(1, min_threads)
+        self.max_threads = max_threads if max_threads is not None else self.nb_cores
+        self.max_threads = max(self.min_threads, self.max_threads)
+        self.min_free_memory = min_free_memory
+        self.period = period
+        self.last_update = None
+        self.load = 0.0
+        self.free_memory = None
+        self.nb_threads = self.max_threads
+
+    def __update(self):
+        now = time.time()
+        if self.last_update is not None and now - self.last_update < self.period:
+            return
+        self.last_update = now
+
+        try:
+            self.load = get_load_average()
+            self.free_memory = get_available_memory()
+        except (OSError, ValueError):
+            # No /proc, stay at the maximum
+            self.load = 0.0
+            self.free_memory = None
+
+    def get_nb_threads(self, nb_running):
+        self.__update()
+        external_load = max(0.0, self.load - nb_running)
+        nb_threads = int(self.nb_cores - external_load)
+        self.nb_threads = min(self.max_threads, max(self.min_threads, nb_threads))
+        return self.nb_threads
+
+    def has_free_memory(self):
+        self.__update()
+        return self.free_memory is None or self.free_memory >= self.min_free_memory
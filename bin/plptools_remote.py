@@ -0,0 +1,294 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Remote execution of builder commands.
+#
+# Worker daemons (plpbuild_worker) listen on a TCP port and execute the
+# commands sent by plpbuild, streaming their output back. The protocol is
+# made of JSON messages, one per line:
+#   worker -> builder: {"type": "hello", "name": ..., "capacity": N}
+#   builder -> worker: {"type": "run", "id": N, "cmd": ..., "path": ..., "env": {...}}
+#   builder -> worker: {"type": "kill", "id": N}
+#   worker -> builder: {"type": "output", "id": N, "data": ...}
+#   worker -> builder: {"type": "end", "id": N, "exit_code": N or null}
+#
+# Commands are executed in the same path as on the builder machine, so the
+# workspace must be shared between the machines.
+
+from twisted.internet import protocol, reactor, error
+from twisted.protocols import basic
+from twisted.python import failure
+import json
+import os
+import shlex
+import socket
+
+
+def get_end_reason(exit_code):
+    # Same reasons as the ones given by twisted for local processes
+    if exit_code == 0:
+        return failure.Failure(error.ProcessDone(None))
+    return failure.Failure(error.ProcessTerminated(exitCode=exit_code))
+
+
+class Message_protocol(basic.LineReceiver):
+
+    delimiter = b'\n'
+    # Messages include the whole command environment
+    MAX_LENGTH = 16*1024*1024
+
+    def send(self, message):
+        self.sendLine(json.dumps(message).encode('utf-8'))
+
+    def lineReceived(self, line):
+        self.message_received(json.loads(line.decode('utf-8')))
+
+    def message_received(self, message):
+        pass
+
+
+#
+# Builder side
+#
+
+class Worker_connection(Message_protocol):
+
+    def __init__(self, executor, address):
+        self.executor = executor
+        self.address = address
+        self.name = address
+        self.capacity = 0
+        self.commands = {}
+
+    def get_free_slots(self):
+        return self.capacity - len(self.commands)
+
+    def run(self, cmd_id, cmd):
+        self.commands[cmd_id] = cmd
+        self.send({'type': 'run', 'id': cmd_id, 'cmd': cmd.cmd,
+                   'path': cmd.path, 'env': cmd.env})
+
+    def kill(self, cmd_id):
+        self.send({'type': 'kill', 'id': cmd_id})
+
+    def message_received(self, message):
+        if message['type'] == 'hello':
+            self.name = message.get('name', self.address)
+            self.capacity = message['capacity']
+            print ('\033[1m' + 'Worker %s' % self.name + '\033[0m' + ': connected with %d slots' % self.capacity)
+            self.executor.worker_ready(self)
+
+        elif message['type'] == 'output':
+            cmd = self.commands.get(message['id'])
+            if cmd is not None:
+                cmd.outReceived(message['data'].encode('utf-8'))
+
+        elif message['type'] == 'end':
+            cmd = self.commands.pop(message['id'], None)
+            if cmd is not None:
+                self.executor.command_ended(cmd)
+                cmd.processEnded(get_end_reason(message['exit_code']))
+
+    def connectionLost(self, reason):
+        # The commands running there are reported as killed, a retry policy
+        # can then send them to another worker
+        commands = self.commands
+        self.commands = {}
+        self.executor.worker_lost(self)
+        for cmd in commands.values():
+            cmd.appendOutput('Lost connection to worker %s\n' % self.name)
+            cmd.processEnded(get_end_reason(None))
+
+
+class Worker_connection_factory(protocol.ClientFactory):
+
+    def __init__(self, executor, address):
+        self.executor = executor
+        self.address = address
+
+    def buildProtocol(self, addr):
+        return Worker_connection(self.executor, self.address)
+
+    def clientConnectionFailed(self, connector, reason):
+        print ('\033[91m' + 'Unable to connect to worker %s: %s' % (self.address, reason.getErrorMessage()) + '\033[0m')
+        self.executor.connection_failed(self.address)
+
+
+class Remote_executor(object):
+    """
+    Executes the builder commands on the connected workers. Commands are
+    queued until a worker has a free slot.
+    """
+
+    def __init__(self, workers):
+        self.workers = []
+        self.waiting = []
+        self.locations = {}
+        self.nb_commands = 0
+        self.connectors = []
+        # Workers which did not say hello yet
+        self.connecting = set(workers)
+
+        for address in workers:
+            host, port = address.rsplit(':', 1)
+            self.connectors.append(reactor.connectTCP(
+                host, int(port), Worker_connection_factory(self, address)))
+
+    def get_capacity(self):
+        if len(self.workers) == 0:
+            return None
+        return sum([worker.capacity for worker in self.workers])
+
+    def spawn(self, cmd):
+        self.waiting.append(cmd)
+        self.__schedule()
+
+    def kill(self, cmd):
+        if cmd in self.waiting:
+            self.waiting.remove(cmd)
+            cmd.processEnded(get_end_reason(None))
+        elif cmd in self.locations:
+            worker, cmd_id = self.locations[cmd]
+            worker.kill(cmd_id)
+
+    def __schedule(self):
+        if len(self.workers) == 0 and len(self.connecting) == 0:
+            # Nothing will ever execute the commands, report them as failed
+            # instead of waiting forever
+            waiting = self.waiting
+            self.waiting = []
+            for cmd in waiting:
+                cmd.appendOutput('No worker available\n')
+                cmd.processEnded(get_end_reason(None))
+            return
+
+        while len(self.waiting) > 0:
+            # Take the worker with the most free slots to spread the load
+            worker = None
+            for candidate in self.workers:
+                if worker is None or candidate.get_free_slots() > worker.get_free_slots():
+                    worker = candidate
+
+            if worker is None or worker.get_free_slots() <= 0:
+                return
+
+            cmd = self.waiting.pop(0)
+            self.nb_commands += 1
+            self.locations[cmd] = [worker, self.nb_commands]
+            worker.run(self.nb_commands, cmd)
+
+    def worker_ready(self, worker):
+        self.connecting.discard(worker.address)
+        if worker not in self.workers:
+            self.workers.append(worker)
+        self.__schedule()
+
+    def connection_failed(self, address):
+        self.connecting.discard(address)
+        self.__schedule()
+
+    def command_ended(self, cmd):
+        self.locations.pop(cmd, None)
+        # Done after the builder got the end of the command so that it can
+        # first enqueue the commands depending on it
+        reactor.callLater(0, self.__schedule)
+
+    def worker_lost(self, worker):
+        self.connecting.discard(worker.address)
+        if worker in self.workers:
+            self.workers.remove(worker)
+        for cmd, location in list(self.locations.items()):
+            if location[0] is worker:
+                del self.locations[cmd]
+        # Done once the builder got the end of the commands which were
+        # running there, as they may be retried
+        reactor.callLater(0, self.__schedule)
+
+    def close(self):
+        for connector in self.connectors:
+            connector.disconnect()
+
+
+#
+# Worker side
+#
+
+class Worker_process(protocol.ProcessProtocol):
+
+    def __init__(self, connection, cmd_id):
+        self.connection = connection
+        self.cmd_id = cmd_id
+
+    def outReceived(self, data):
+        self.connection.send({'type': 'output', 'id': self.cmd_id,
+                              'data': data.decode('utf-8', errors='ignore')})
+
+    def processEnded(self, reason):
+        self.connection.processes.pop(self.cmd_id, None)
+        self.connection.send({'type': 'end', 'id': self.cmd_id,
+                              'exit_code': reason.value.exitCode})
+
+
+class Worker_protocol(Message_protocol):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.processes = {}
+
+    def connectionMade(self):
+        self.send({'type': 'hello', 'name': socket.gethostname(),
+                   'capacity': self.capacity})
+
+    def message_received(self, message):
+        if message['type'] == 'run':
+            print ('\033[1m' + '%d' % message['id'] + '\033[0m' + ': %s' % message['cmd'])
+            process = Worker_process(self, message['id'])
+            try:
+                args = shlex.split(message['cmd'])
+                self.processes[message['id']] = reactor.spawnProcess(
+                    process, path=message['path'], executable=args[0],
+                    args=args, usePTY=True, env=message['env'])
+            except Exception as e:
+                process.outReceived(('Unable to start command: %s\n' % e).encode('utf-8'))
+                self.send({'type': 'end', 'id': message['id'], 'exit_code': -1})
+
+        elif message['type'] == 'kill':
+            process = self.processes.get(message['id'])
+            if process is not None:
+                process.signalProcess('KILL')
+
+    def connectionLost(self, reason):
+        # Nobody is waiting for the results anymore
+        for process in list(self.processes.values()):
+            try:
+                process.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+
+
+class Worker_factory(protocol.Factory):
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity if capacity is not None else (os.cpu_count() or 1)
+
+    def buildProtocol(self, addr):
+        return Worker_protocol(self.capacity)
+
+
+def start_worker(port, capacity=None, interface='127.0.0.1'):
+    # Anyone able to connect can execute commands, so only listen on the
+    # loopback interface unless told otherwise
+    return reactor.listenTCP(port, Worker_factory(capacity), interface=interface)
@@ -0,0 +1,95 @@
+#
+# Copyright (C) 2018 ETH Zurich and University of Bologna
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import time
+
+
+class Build_trace(object):
+    """
+    Timeline of the builder commands, dumped in Chrome Trace Event format
+    so that it can be opened in chrome://tracing or Perfetto.
+    Each command appears on the track of the worker slot which executed it,
+    and the time it spent waiting for a free slot appears on the queue track.
+    """
+
+    EXEC_PID = 1
+    QUEUE_PID = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.start_time = time.time()
+        self.events = []
+        self.slots = set()
+
+    def __get_ts(self, date):
+        return int((date - self.start_time) * 1000000)
+
+    def record(self, cmd):
+        if cmd.start_time is None or cmd.end_time is None:
+            return
+
+        args = {
+            'cmd': cmd.cmd,
+            'status': cmd.exit_code,
+            'enqueued': self.__get_ts(cmd.enqueue_time),
+            'ready': self.__get_ts(cmd.ready_time),
+            'deps_wait_us': self.__get_ts(cmd.ready_time) - self.__get_ts(cmd.enqueue_time),
+            'queue_wait_us': self.__get_ts(cmd.start_time) - self.__get_ts(cmd.ready_time),
+            'cached': cmd.cached,
+            'attempt': cmd.attempt
+        }
+
+        self.slots.add(cmd.slot)
+
+        # Each attempt of a retried command appears as a separate event
+        name = cmd.name
+        if cmd.attempt > 1:
+            name += ' (attempt %d)' % cmd.attempt
+
+        self.events.append({
+            'name': name, 'cat': 'cmd', 'ph': 'X',
+            'pid': self.EXEC_PID, 'tid': cmd.slot,
+            'ts': self.__get_ts(cmd.start_time),
+            'dur': self.__get_ts(cmd.end_time) - self.__get_ts(cmd.start_time),
+            'args': args
+        })
+
+        # Async events can overlap on the same track, which is what we need
+        # as many commands are usually waiting at the same time
+        for phase, date in [['b', cmd.ready_time], ['e', cmd.start_time]]:
+            self.events.append({
+                'name': name, 'cat': 'queue', 'ph': phase,
+                'pid': self.QUEUE_PID, 'tid': 0,
+                'id': '%d.%d' % (cmd.enqueue_id, cmd.attempt),
+                'ts': self.__get_ts(date)
+            })
+
+    def save(self):
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': self.EXEC_PID,
+             'args': {'name': 'Workers'}},
+            {'name': 'process_name', 'ph': 'M', 'pid': self.QUEUE_PID,
+             'args': {'name': 'Queue'}}
+        ]
+        for slot in sorted(self.slots):
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': self.EXEC_PID, 'tid': slot,
+                           'args': {'name': 'slot %d' % slot}})
+
+        with open(self.path, 'w') as fd:
+            json.dump({'traceEvents': events + self.events,
+                       'displayTimeUnit': 'ms'}, fd)
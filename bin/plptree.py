@@ -20,11 +20,68 @@
 import json
 import os.path
 from collections import OrderedDict
+from collections.abc import MutableMapping
 import plpuserconfig
 import shlex
 import Regmap as regmap
 import os
 import os.path
+import pickle
+import hashlib
+
+
+# Parsed JSON files, keyed by their real path. The dictionaries are shared
+# between all the trees built from them and must never be modified.
+json_cache = {}
+
+# Files read by the trees being built, to get the include closure of the
+# ones whose resolved tree is stored in the disk cache
+json_recorders = []
+
+def load_json(file):
+  real_path = os.path.realpath(file)
+  stat = os.stat(real_path)
+  signature = (stat.st_mtime_ns, stat.st_size)
+
+  for recorder in json_recorders:
+    recorder.append([real_path, signature])
+
+  entry = json_cache.get(real_path)
+  if entry is None or entry[0] != signature:
+    with open(real_path, 'r') as fd:
+      entry = [signature, json.load(fd, object_pairs_hook=OrderedDict)]
+    json_cache[real_path] = entry
+
+  return entry[1]
+
+
+# Property names of the nodes which can't have properties
+no_keys = frozenset()
+
+# Number of includes_eval evaluated, these make the tree depend on its own
+# values so it can't be specialized from a generic one
+nb_includes_eval = 0
+
+
+def get_child_args(args, key):
+  # Args which apply to the children of the property
+  child_args = []
+  for arg in args:
+    if arg[0][0] == '*' or arg[0][0] == key:
+      child_args.append([arg[0][1:], arg[1]])
+    elif (arg[0][0] in ['*', '**']) and (arg[0][1] == key):
+      child_args.append([arg[0][2:], arg[1]])
+    elif arg[0][0] == '**':
+      child_args.append(arg)
+  return child_args
+
+def get_arg_values(args, key):
+  # Values of the args which replace the property
+  values = []
+  for arg in args:
+    if (len (arg[0]) == 1 and arg[0][0] == key) or (len(arg[0]) == 2 and arg[0][0] in ['*', '**'] and arg[0][1] == key):
+      values.append(arg[1])
+  return values
 
 class Generic_elem(object):
 
@@ -64,6 +121,10 @@ class Generic_elem(object):
 
 
 class List_elem(Generic_elem):
+
+  # Names of all the properties in the elements, computed when needed
+  _keys = None
+
   def __init__(self, graph, path):
     super(List_elem, self).__init__(path)
     self.elems = []
@@ -81,18 +142,26 @@ class List_elem(Generic_elem):
   def get_elem(self, index):
     return self.elems[index]
 
+  def copy(self):
+    result = List_elem([], self.path)
+    result.elems = [elem.copy() for elem in self.elems]
+    return result
+
   def __delitem__(self, key):
+    self._keys = None
     del self.elems[key]
 
   def __getitem__(self, key):
     return self.elems[key]
 
   def __setitem__(self, key, value):
+    self._keys = None
     self.elems[key] = value
 
   def __call__(self): return self.get_dict(serialize=False)
 
   def merge(self, tree):
+    self._keys = None
     for i in range(0, len(tree.elems)):
       self.elems.append(tree[i])
 
@@ -104,6 +173,7 @@ class List_elem(Generic_elem):
     return result
 
   def set(self, name, value, set_first=False):
+    self._keys = None
     if name == None:
       if set_first:
         self.elems.append(self.get_tree(value))
@@ -128,6 +198,21 @@ class List_elem(Generic_elem):
           return value
       return None
 
+  def _find_node(self, name, rec, tree):
+    for elem in self.elems:
+      node = elem._find_node(name, rec, tree)
+      if node is not None:
+        return node
+    return None
+
+  def _get_keys(self):
+    if self._keys is None:
+      keys = set()
+      for elem in self.elems:
+        keys.update(elem._get_keys())
+      self._keys = keys
+    return self._keys
+
   def dump_help(self, name=None, root=None):
       for elem in self.elems:
         elem.dump_help(name=name)
@@ -157,6 +242,9 @@ class Value_elem(Generic_elem):
     def merge(self, tree):
         self.value = tree.value
 
+    def copy(self):
+        return Value_elem(self.value)
+
     def __call__(self):
         return self.value
 
@@ -184,27 +272,109 @@ class Value_elem(Generic_elem):
         else:
             return None
 
+    def _find_node(self, name, rec, tree):
+        return None
+
+    def _get_keys(self):
+        return no_keys
+
     def dump_help(self, name=None, root=None):
         pass
 
 
 
-def find_config(config, path=None):
-  all_paths = os.environ['PULP_CONFIGS_PATH'].split(':')
-  if path is not None:
-    all_paths = all_paths + [path]
+class Config_locator(object):
+  """
+  Finds the configuration files in the PULP_CONFIGS_PATH directories.
+  Each directory is listed once and each name is resolved once for the
+  whole process, which avoids stat calls on slow file systems.
+  The hit and miss counters tell how many resolutions were served from
+  the memoized ones.
+  """
+
+  def __init__(self):
+    self.listings = {}
+    self.resolved = {}
+    self.hits = 0
+    self.misses = 0
+    self.nb_listings = 0
+
+  def invalidate(self):
+    self.listings = {}
+    self.resolved = {}
+
+  def __get_listing(self, dir_path):
+    listing = self.listings.get(dir_path)
+    if listing is None:
+      self.nb_listings += 1
+      listing = {}
+      try:
+        with os.scandir(dir_path) as entries:
+          for entry in entries:
+            listing[entry.name] = entry
+      except OSError:
+        pass
+      self.listings[dir_path] = listing
+    return listing
+
+  def exists(self, dir_path, name):
+    components = name.split('/')
+    # Relative components can't be checked with the listings
+    if os.path.isabs(name) or '.' in components or '..' in components:
+      return os.path.exists(os.path.join(dir_path, name))
+
+    for component in components[:-1]:
+      if component == '': continue
+      entry = self.__get_listing(dir_path).get(component)
+      if entry is None or not entry.is_dir():
+        return False
+      dir_path = os.path.join(dir_path, component)
+
+    entry = self.__get_listing(dir_path).get(components[-1])
+    if entry is None:
+      return False
+    if entry.is_symlink():
+      # The link may be broken
+      return os.path.exists(entry.path)
+    return True
+
+  def find(self, config, path=None):
+    all_paths = os.environ['PULP_CONFIGS_PATH'].split(':')
+    if path is not None:
+      all_paths = all_paths + [path]
+
+    key = (config, tuple(all_paths))
+    if key in self.resolved:
+      self.hits += 1
+      return self.resolved[key]
+    self.misses += 1
+
+    result = None
+    for dir_path in all_paths:
+      if self.exists(dir_path, config):
+        result = os.path.join(dir_path, config)
+        break
+
+    self.resolved[key] = result
+    return result
 
-  for path in all_paths:
-    full_path = os.path.join(path, config)
-    if os.path.exists(full_path):
-      return full_path
 
-  return None
+config_locator = Config_locator()
+
+def find_config(config, path=None):
+  return config_locator.find(config, path)
 
 
 
 class Tree_elem(Generic_elem):
 
+  # Results of the lookups by name, forgotten when the tree is modified.
+  # This only sees the modifications done through this tree, so the
+  # sub-trees it returns must not be modified directly.
+  _lookups = None
+  # Names of all the properties in the tree, computed when needed
+  _keys = None
+
   def __init__(self, config_dict, path, name=None, args=[], config_name=None):
     super(Tree_elem, self).__init__(path)
     self.props = OrderedDict()
@@ -224,6 +394,8 @@ class Tree_elem(Generic_elem):
           self.merge(tree)
 
       elif key == 'includes_eval':
+        global nb_includes_eval
+        nb_includes_eval += 1
         config = self
         for inc in value:
           tree = get_config_tree_from_file(find_config(eval(inc), self.path), args=args)
@@ -231,25 +403,50 @@ class Tree_elem(Generic_elem):
 
       else:
 
-        child_args = []
-        for arg in args:
-          if arg[0][0] == '*' or arg[0][0] == key:
-            child_args.append([arg[0][1:], arg[1]])
-          elif (arg[0][0] in ['*', '**']) and (arg[0][1] == key):
-            child_args.append([arg[0][2:], arg[1]])
-          elif arg[0][0] == '**':
-            child_args.append(arg)
+        child_args = get_child_args(args, key)
 
         set_prop = False
 
-        for arg in args:
-          if (len (arg[0]) == 1 and arg[0][0] == key) or (len(arg[0]) == 2 and arg[0][0] in ['*', '**'] and arg[0][1] == key):
-            self.set_prop(key, Value_elem(arg[1]))
-            set_prop = True
+        for arg_value in get_arg_values(args, key):
+          self.set_prop(key, Value_elem(arg_value))
+          set_prop = True
 
         if not set_prop:
           self.set_prop(key, self.get_tree(value, args=child_args))
 
+  def specialize(self, args=[], name=None, config_name=None):
+    """
+    Return the tree with the args applied as if they had been given when it
+    was built, without reading the files again.
+    The result is an overlay sharing the nodes of this tree, which must
+    then not be modified anymore.
+    """
+    result = Overlay_elem(self, name=name, config_name=config_name)
+
+    # An arg can only replace the properties with its last name, the
+    # sub-trees having none of them are kept shared without visiting them
+    keys = self._get_keys()
+    args = [arg for arg in args if len(arg[0]) != 0 and arg[0][-1] in keys]
+    if len(args) == 0:
+      return result
+
+    for key, prop in self.props.items():
+      values = get_arg_values(args, key)
+      if len(values) != 0:
+        result.props[key] = Value_elem(values[-1])
+      elif isinstance(prop, Tree_elem):
+        child_args = get_child_args(args, key)
+        if len(child_args) != 0:
+          child = prop.specialize(child_args)
+          # Keep sharing the sub-tree if no arg applied to it
+          if child.is_modified():
+            result.props[key] = child
+
+    return result
+
+  def copy(self):
+    return self.specialize()
+
   def dump_doc_internal(self, dump_regs=False, dump_regs_fields=False, header=None):
       regmap_conf = self.props.get('regmap')
       if regmap_conf is not None:
@@ -300,6 +497,7 @@ class Tree_elem(Generic_elem):
     return self.name.replace('=', '.').replace(':', '_')
 
   def set_prop(self, key, value):
+    self._modified()
     if key in self.props:
       self.props.get(key).merge(value)
     else:
@@ -307,6 +505,7 @@ class Tree_elem(Generic_elem):
       self.__dict__[key] = value
 
   def merge(self, tree):
+    self._modified()
     for key, value in tree.props.items():
       if self.props.get(key) != None:
         self.props.get(key).merge(value)
@@ -357,17 +556,72 @@ class Tree_elem(Generic_elem):
         else:
           return list(self.props.keys())[0]
     else:
-      name_list = name.split('/')
-      parent_name = name_list[0]
-      elem = self.props.get(parent_name)
-      if elem == None:
-        for prop in self.props.values():
-          value = prop.get(name, rec, tree)
-          if value != None: return value
-        return None
+      # Properties may be searched anywhere in the tree, which is also what
+      # the ** wildcard means
+      if name.startswith('**/'): name = name[3:]
+
+      # A full path from this node always resolves to the node at this path
+      elem = self.__get_path_node(name)
+      if elem is not None:
+        return elem.get(None, rec, tree)
+
+      if self._lookups is None:
+        self._lookups = {}
+      key = (name, rec, tree)
+      if key in self._lookups:
+        elem = self._lookups[key]
       else:
-        child_name = None if len(name_list) == 1 else '/'.join(name_list[1:])
-        return elem.get(child_name, rec, tree)
+        elem = self._find_node(name, rec, tree)
+        self._lookups[key] = elem
+
+      if elem is None: return None
+      return elem.get(None, rec, tree)
+
+  def _find_node(self, name, rec, tree):
+    # Return the node whose value is returned when getting this name
+    name_list = name.split('/')
+    parent_name = name_list[0]
+    elem = self.props.get(parent_name)
+    if elem == None:
+      for prop in self.props.values():
+        if parent_name not in prop._get_keys(): continue
+        node = prop._find_node(name, rec, tree)
+        if node is not None: return node
+      return None
+    elif len(name_list) == 1:
+      return elem if elem.get(None, rec, tree) != None else None
+    else:
+      return elem._find_node('/'.join(name_list[1:]), rec, tree)
+
+  def __getstate__(self):
+    # The lookups are done again when needed, no need to store them
+    state = self.__dict__.copy()
+    state.pop('_lookups', None)
+    state.pop('_keys', None)
+    return state
+
+  def _modified(self):
+    self._lookups = None
+    self._keys = None
+
+  def _get_keys(self):
+    if self._keys is None:
+      keys = set(self.props.keys())
+      for prop in self.props.values():
+        keys.update(prop._get_keys())
+      self._keys = keys
+    return self._keys
+
+  def __get_path_node(self, name):
+    # Node at this path going through dictionaries only, if any
+    node = self
+    for key in name.split('/'):
+      if not isinstance(node, Tree_elem):
+        return None
+      node = node.props.get(key)
+      if node is None:
+        return None
+    return node
 
 
 
@@ -397,15 +651,19 @@ class Tree_elem(Generic_elem):
           self.set_prop(parent_name, self.get_tree(value))
 
         else:
-          for prop in self.props.values():
-            is_set = is_set or prop.set(name, value, set_first=set_first)
+          for key in list(self.props.keys()):
+            is_set = is_set or self._set_prop_value(key, name, value, set_first)
 
         return is_set
       else:
         child_name = None if len(name_list) == 1 else '/'.join(name_list[1:])
-        return elem.set(child_name, value, set_first=set_first)
+        return self._set_prop_value(parent_name, child_name, value, set_first)
+
+  def _set_prop_value(self, key, name, value, set_first):
+    return self.props[key].set(name, value, set_first=set_first)
 
   def set(self, name, value, set_first=None):
+    self._modified()
     if set_first != None:
       self.__set(name, value, set_first=set_first)
     else:
@@ -433,6 +691,161 @@ class Tree_elem(Generic_elem):
 
 
 
+class Overlay_props(MutableMapping):
+  """
+  Properties of a base tree seen through the overrides and deletions of an
+  overlay. The base properties keep their order, new ones come after.
+  """
+
+  def __init__(self, base):
+    self.base = base
+    self.overrides = OrderedDict()
+    self.deleted = set()
+
+  def __getitem__(self, key):
+    if key in self.overrides:
+      return self.overrides[key]
+    if key in self.deleted:
+      raise KeyError(key)
+    return self.base[key]
+
+  def __contains__(self, key):
+    return key in self.overrides or (key not in self.deleted and key in self.base)
+
+  def __iter__(self):
+    for key in self.base:
+      if key not in self.deleted:
+        yield key
+    for key in self.overrides:
+      if key in self.deleted or key not in self.base:
+        yield key
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __setitem__(self, key, value):
+    self.overrides[key] = value
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self.overrides.pop(key, None)
+    if key in self.base:
+      self.deleted.add(key)
+
+
+class Overlay_elem(Tree_elem):
+  """
+  Tree sharing the nodes of a base tree and only storing its own
+  modifications. A base node is copied the first time it is modified
+  through the overlay, dictionaries being themselves copied as overlays,
+  so the base tree is never modified.
+  Nodes returned by get(tree=True) may belong to the base tree and must
+  not be modified directly.
+  """
+
+  def __init__(self, base, name=None, config_name=None):
+    Generic_elem.__init__(self, base.path)
+    self.props = Overlay_props(base.props)
+    self.name = name if name is not None else base.name
+    self.config_name = config_name if config_name is not None else base.config_name
+
+  def __getattr__(self, name):
+    # Properties are also reachable as attributes, as for Tree_elem
+    props = self.__dict__.get('props')
+    if props is not None and name in props:
+      return props[name]
+    raise AttributeError(name)
+
+  def is_modified(self):
+    return len(self.props.overrides) != 0 or len(self.props.deleted) != 0
+
+  def __get_writable_prop(self, key):
+    prop = self.props.overrides.get(key)
+    if prop is None:
+      prop = self.props[key]
+      if isinstance(prop, Tree_elem):
+        prop = Overlay_elem(prop)
+      else:
+        prop = prop.copy()
+      self.props.overrides[key] = prop
+    return prop
+
+  def _set_prop_value(self, key, name, value, set_first):
+    is_copied = key not in self.props.overrides
+    # A shared property can only be modified if it has the property being
+    # set or if it gets it added, otherwise it is not worth a copy
+    if is_copied and name is not None and not (set_first and name.find('/') == -1) and \
+        name.split('/')[0] not in self.props[key]._get_keys():
+      return False
+    prop = self.__get_writable_prop(key)
+    is_set = prop.set(name, value, set_first=set_first)
+    # Most sets are propagated to properties which don't have what is set,
+    # don't keep a copy of them
+    if is_copied and (isinstance(prop, Overlay_elem) and not prop.is_modified() or
+        isinstance(prop, Value_elem) and not is_set):
+      del self.props.overrides[key]
+    return is_set
+
+  def set_prop(self, key, value):
+    self._modified()
+    if key in self.props:
+      self.__get_writable_prop(key).merge(value)
+    else:
+      self.props[key] = value
+
+  def merge(self, tree):
+    self._modified()
+    for key, value in tree.props.items():
+      self.set_prop(key, value)
+
+
+
+# Must be increased whenever the layout of the trees or of the cache entries
+# changes, so that the trees pickled by older versions are not loaded
+TREE_CACHE_VERSION = 1
+
+def get_tree_cache_path(cache_dir, file, name, args, path):
+  # Includes are searched in PULP_CONFIGS_PATH, the result depends on it
+  key = repr([TREE_CACHE_VERSION, os.path.realpath(file), name, args, path,
+              os.environ.get('PULP_CONFIGS_PATH')])
+  return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pickle')
+
+def load_cached_tree(cache_path):
+  global nb_includes_eval
+
+  try:
+    with open(cache_path, 'rb') as fd:
+      closure, nb_evals, tree = pickle.load(fd)
+  except Exception:
+    return None
+
+  # The tree is only valid if none of the files it was built from changed
+  for file_path, signature in closure:
+    try:
+      stat = os.stat(file_path)
+    except OSError:
+      return None
+    if (stat.st_mtime_ns, stat.st_size) != tuple(signature):
+      return None
+
+  # Replay the includes_eval done while building the tree, the callers
+  # rely on them to know if the tree depends on its own values
+  nb_includes_eval += nb_evals
+
+  return tree
+
+def store_cached_tree(cache_path, closure, nb_evals, tree):
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as fd:
+      pickle.dump([closure, nb_evals, tree], fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+  except (OSError, pickle.PicklingError, RecursionError):
+    # The cache is only an optimization
+    pass
+
 def get_config_tree_from_file(file, name='', args=[], path=None):
 
   try:
@@ -440,11 +853,33 @@ def get_config_tree_from_file(file, name='', args=[], path=None):
   except:
       pass
 
-  with open(file, 'r') as fd:
-    config_dict = json.load(fd, object_pairs_hook=OrderedDict)
   if path is None:
     path = os.path.dirname(file)
-  return Tree_elem(config_dict=config_dict, path=path, name=name, args=args)
+
+  # Fully resolved trees can be kept on disk, only for the top files as the
+  # included ones are part of them
+  cache_dir = os.environ.get('PULP_CONFIGS_CACHE')
+  cache_path = None
+  if cache_dir is not None and len(json_recorders) == 0:
+    cache_path = get_tree_cache_path(cache_dir, file, name, args, path)
+    tree = load_cached_tree(cache_path)
+    if tree is not None:
+      return tree
+
+  if cache_path is None:
+    return Tree_elem(config_dict=load_json(file), path=path, name=name, args=args)
+
+  closure = []
+  nb_evals = nb_includes_eval
+  json_recorders.append(closure)
+  try:
+    tree = Tree_elem(config_dict=load_json(file), path=path, name=name, args=args)
+  finally:
+    json_recorders.pop()
+
+  store_cached_tree(cache_path, closure, nb_includes_eval - nb_evals, tree)
+
+  return tree
 
 def get_config_tree_from_dict(config_dict, name='', path=None, args=[], config_name=''):
   return Tree_elem(config_dict=config_dict, name=name, path=path, args=args, config_name=config_name)
@@ -498,6 +933,40 @@ def append_args(config_tree, args, args_init):
                   key = key[1:]
                 config_tree.set(key, value)
 
+def get_config_tree_from_files(config_files, path, name, args):
+    config_tree = None
+    for config_file in config_files:
+        if os.path.exists(os.path.abspath(config_file)):
+            config_file = os.path.abspath(config_file)
+        elif os.path.exists(os.path.join(path, config_file)):
+            config_file = os.path.join(path, config_file)
+        tree = get_config_tree_from_file(config_file, name=name, args=args)
+        if config_tree is None:
+            config_tree = tree
+        else:
+            config_tree.merge(tree)
+    return config_tree
+
+def get_specialized_config_tree(config_files, path, name, args, nb_common_args, generic_trees):
+    # The tree of all possible configurations only depends on the args
+    # common to all configurations, it is built once and each configuration
+    # gets a copy with its own args applied
+    key = repr([config_files, path, args[:nb_common_args]])
+    generic_tree = generic_trees.get(key)
+    if generic_tree is None:
+        nb_evals = nb_includes_eval
+        generic_tree = get_config_tree_from_files(config_files, path, name, args[:nb_common_args])
+        # Includes evaluated from the tree values may depend on the
+        # configuration args, such trees must be built for each of them
+        if nb_includes_eval != nb_evals:
+            generic_tree = False
+        generic_trees[key] = generic_tree
+
+    if generic_tree is False:
+        return get_config_tree_from_files(config_files, path, name, args)
+
+    return generic_tree.specialize(args[nb_common_args:], name=name)
+
 def get_configs(config_files=None, config_string=None, path=None, config_file=None, no_args=False, no_config_args=False):
 
     if config_string is None:
@@ -520,6 +989,8 @@ def get_configs(config_files=None, config_string=None, path=None, config_file=No
 
 
     else:
+      generic_trees = {}
+
       # For each specified configuration, first get a tree of all possible
       # configurations and specialize it to reflect the configuration
       for config in shlex.split(config_string.replace(';', ' ')):
@@ -529,6 +1000,7 @@ def get_configs(config_files=None, config_string=None, path=None, config_file=No
           args_list = []
           for key, value in plpuserconfig.Args(os.environ.get('PULP_CURRENT_CONFIG_ARGS_NEW')).get().items():
             args_list.append([key.split('/'), value])
+          nb_common_args = len(args_list)
 
           full_config = config
 
@@ -590,17 +1062,8 @@ def get_configs(config_files=None, config_string=None, path=None, config_file=No
           elif config.find('config_file') == -1:
             # Otherwise just build the possible set of configurations
             # from the detailed system configurations
-            config_tree = None
-            for config_file in config_files:
-                if os.path.exists(os.path.abspath(config_file)):
-                    config_file = os.path.abspath(config_file)
-                elif os.path.exists(os.path.join(path, config_file)):
-                    config_file = os.path.join(path, config_file)
-                tree = get_config_tree_from_file(config_file, name=config, args=args_list)
-                if config_tree is None:
-                    config_tree = tree
-                else:
-                    config_tree.merge(tree)
+            config_tree = get_specialized_config_tree(
+              config_files, path, config, args_list, nb_common_args, generic_trees)
 
           # For the specialization, take each specified item and set it into the
           # tree this will specialize it.